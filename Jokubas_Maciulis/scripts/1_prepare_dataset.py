@@ -1,5 +1,50 @@
-import pandas as pd
-from src.preprocessing import load_dataset_from_txt
+import argparse
+import json
+import os
+
+import numpy as np
+
+from src.preprocessing import (load_dataset_from_txt, iterate_dataset_from_txt, default_specs,
+                               branches_for_specs, io_report_table, cutflow_table, RootFileCache,
+                               plan_entry_ranges, probe_files, preselection_cuts, parse_step_size)
+from src.dataset import (DATASET_PATH, DatasetStats, sample_name_from_txt, write_sample_shards, ShuffledShardWriter,
+                         clear_dataset)
+from src.instrumentation import RunReport
+from src.incremental import build_sample_incremental, manifest_stats, open_manifest, prune_manifest, settings_key
+
+parser = argparse.ArgumentParser(description="Build the processed electron dataset from NanoAOD file indices")
+parser.add_argument("--workers", type=int, default=1, help="Number of files read concurrently per index")
+parser.add_argument("--executor", choices=["process", "thread"], default="process", help="Worker pool type")
+parser.add_argument("--split-entries", type=int, default=None,
+                    help="With --workers, split files into cluster-aligned ranges of about this many entries")
+parser.add_argument("--stream", action="store_true", help="Read and flatten the files chunk by chunk instead of whole files")
+parser.add_argument("--step-size", default="100 MB", help="Chunk size for --stream, number of entries or a size like '100 MB'")
+parser.add_argument("--prefetch", type=int, default=1,
+                    help="Files (or --stream chunks) read ahead in a background thread without --workers (0 = off)")
+parser.add_argument("--min-electrons", type=int, default=0, help="Preselection: keep events with at least this many electrons")
+parser.add_argument("--min-lead-pt", type=float, default=None, help="Preselection: leading electron pT threshold in GeV")
+parser.add_argument("--cache-dir", default=None, help="Keep local copies of the remote ROOT files in this directory")
+parser.add_argument("--cache-max-gb", type=float, default=None, help="Size cap of the cache, least recently used files are removed")
+parser.add_argument("--offline", action="store_true", help="Read only from --cache-dir, never from EOS")
+parser.add_argument("--probe-workers", type=int, default=16, help="Files whose entry counts are fetched concurrently before reading")
+parser.add_argument("--metadata-cache", default="data/file_metadata.json",
+                    help="JSON cache of the entry counts and cluster boundaries of the input files")
+parser.add_argument("--skim-dir", default=None,
+                    help="Read the skims written by scripts.skim (e.g. data/skims) instead of the original files")
+parser.add_argument("--no-event-features", action="store_true",
+                    help="Only the padded object columns, without mee, dR_ee, dRmin_ej, HT and jet-electron overlap removal")
+parser.add_argument("--output", default=DATASET_PATH, help="Output directory of the Parquet dataset")
+parser.add_argument("--shuffle-buckets", type=int, default=16,
+                    help="Shuffle all samples out of core through this many on-disk buckets (0 = one unshuffled partition per sample)")
+parser.add_argument("--incremental", action="store_true",
+                    help="Keep one shard per input file and only (re)build files that are new or changed (no global shuffle)")
+parser.add_argument("--seed", type=int, default=42, help="Seed of the shuffle")
+parser.add_argument("--report", default="results/prepare_report.json", help="JSON run report with per-stage timing and memory")
+parser.add_argument("--row-group-size", type=int, default=10_000, help="Rows per Parquet row group")
+args = parser.parse_args()
+
+if args.offline and args.cache_dir is None:
+    parser.error("--offline needs --cache-dir")
 
 signal_files = [
     "data/raw/signal/CMS_mc_RunIISummer20UL16NanoAODv9_DYJetsToLL_M-10to50_TuneCP5_13TeV-amcatnloFXFX-pythia8_NANOAODSIM_106X_mcRun2_asymptotic_v17-v1_2520000_file_index.txt",
@@ -17,30 +62,109 @@ background_files = [
     "data/raw/background/CMS_mc_RunIISummer20UL16NanoAODv9_ZZ_TuneCP5_13TeV-pythia8_NANOAODSIM_106X_mcRun2_asymptotic_v17-v1_130000_file_index.txt"
 ]
 
-branches = ["Electron_pt", "Electron_eta", "Electron_miniPFRelIso_all",
-    "Electron_miniPFRelIso_chg", "Electron_dz", "Electron_dxy", "Electron_ip3d"]
+if args.skim_dir is not None:
+    # Same index names, listing the preselected skims
+    signal_files = [os.path.join(args.skim_dir, os.path.relpath(f, "data/raw")) for f in signal_files]
+    background_files = [os.path.join(args.skim_dir, os.path.relpath(f, "data/raw")) for f in background_files]
 
-branches += [
-    "Jet_pt",
-    "Jet_eta",
-    "Jet_phi",
-    "Jet_btagDeepFlavB"
-]
+# Output features; the branches read from the ROOT files are derived from these
+specs = default_specs(max_electrons=2, max_jets=4, event_features=not args.no_event_features)
+
+# Preselection, evaluated on the jagged arrays before flattening
+cuts = preselection_cuts(args.min_electrons, args.min_lead_pt)
+
+branches = branches_for_specs(specs, cuts)
 
-dfs = []
+# Wall/CPU time, peak RSS and bytes read/written per stage
+report = RunReport("prepare")
+
+cache = None
+if args.cache_dir is not None:
+    max_bytes = None if args.cache_max_gb is None else int(args.cache_max_gb * 1e9)
+    cache = RootFileCache(args.cache_dir, max_bytes=max_bytes, offline=args.offline)
+
+# Bytes read per branch, summed over all samples
+io_report = {}
+
+# Events passing each cut, per sample
+cutflows = {}
+
+def load(f, target_label, max_events):
+    cutflow = cutflows.setdefault(sample_name_from_txt(f), {})
+    if args.stream:
+        return iterate_dataset_from_txt(f, target_label=target_label, max_events=max_events, branches=branches,
+                                        step_size=parse_step_size(args.step_size), specs=specs, io_report=io_report,
+                                        cuts=cuts, cutflow=cutflow, cache=cache, report=report, metadata=metadata,
+                                        prefetch=args.prefetch)
+    return [load_dataset_from_txt(f, target_label=target_label, max_events=max_events, branches=branches,
+                                  n_workers=args.workers, executor=args.executor, specs=specs,
+                                  io_report=io_report, cuts=cuts, cutflow=cutflow, cache=cache, report=report,
+                                  split_entries=args.split_entries, metadata=metadata, prefetch=args.prefetch)]
 
 signal_max = 200000
 background_max = 50000
 
-for f in signal_files:
-    dfs.append(load_dataset_from_txt(f, target_label=1, max_events = signal_max, branches=branches))
+# Entry counts of every file in every index, fetched concurrently (and cached)
+# so the exact ranges that fill each quota are known before reading
+samples = [(f, 1, signal_max) for f in signal_files] + [(f, 0, background_max) for f in background_files]
+index_files = {f: np.atleast_1d(np.loadtxt(f, dtype=str)) for f, _, _ in samples}
+with report.stage("probe"):
+    metadata = probe_files(np.concatenate(list(index_files.values())), n_workers=args.probe_workers, cache=cache,
+                           metadata_path=args.metadata_cache)
+for f, _, max_events in samples:
+    ranges = plan_entry_ranges(index_files[f], metadata, max_events)
+    print(f"{sample_name_from_txt(f)}: {sum(stop - start for _, start, stop in ranges)} events "
+          f"from {len(ranges)} of {len(index_files[f])} files")
+
+if args.incremental:
+    # One shard per input file, recorded in <output>/_manifest.json together
+    # with a fingerprint of the file; unchanged files are not read again
+    manifest = open_manifest(args.output)
+    settings = settings_key(specs=specs, cuts=cuts, branches=branches, row_group_size=args.row_group_size)
+    kept = []
+    for f, target_label, max_events in samples:
+        sample = sample_name_from_txt(f)
+        files, built = build_sample_incremental(
+            f, target_label, args.output, sample, manifest, settings, max_events=max_events,
+            row_group_size=args.row_group_size, cutflow=cutflows.setdefault(sample, {}), report=report,
+            branches=branches, specs=specs, io_report=io_report, cuts=cuts, cache=cache
+        )
+        print(f"{sample}: {built} of {len(files)} files rebuilt")
+        kept += files
+    prune_manifest(args.output, manifest, kept)
+    stats = manifest_stats(manifest)
+elif args.shuffle_buckets > 0:
+    # Globally shuffled shards <output>/part-*.parquet with a "sample" column,
+    # memory is bounded by one bucket
+    stats = DatasetStats()
+    writer = ShuffledShardWriter(args.output, n_buckets=args.shuffle_buckets, seed=args.seed,
+                                 row_group_size=args.row_group_size, report=report, stats=stats)
+    for f, target_label, max_events in samples:
+        for block in load(f, target_label=target_label, max_events=max_events):
+            writer.add(block, sample=sample_name_from_txt(f))
+    writer.close()
+else:
+    # Every file index becomes one sample partition: <output>/sample=<name>/part-*.parquet
+    clear_dataset(args.output)
+    stats = DatasetStats()
+    for f in signal_files:
+        write_sample_shards(load(f, target_label=1, max_events=signal_max), args.output,
+                            sample_name_from_txt(f), row_group_size=args.row_group_size, report=report, stats=stats)
+
+    for f in background_files:
+        write_sample_shards(load(f, target_label=0, max_events=background_max), args.output,
+                            sample_name_from_txt(f), row_group_size=args.row_group_size, report=report, stats=stats)
 
-for f in background_files:
-    dfs.append(load_dataset_from_txt(f, target_label=0, max_events = background_max, branches=branches))
+# Count, mean, variance, min, max and zero fraction of every feature per row
+# group, so training standardizes from them without another pass
+stats.save(args.output)
+print(stats.table().to_string(index=False, float_format=lambda x: f"{x:.4g}"))
 
-df = pd.concat(dfs, ignore_index=True)
+print(io_report_table(io_report).to_string(index=False))
 
-# Shuffle dataset
-df = df.sample(frac=1, random_state=42).reset_index(drop=True)
+print(cutflow_table(cutflows).to_string())
+with open(os.path.join(args.output, "_cutflow.json"), "w") as f:
+    json.dump(cutflows, f, indent=2)
 
-df.to_csv("data/processed/electron_dataset.csv", index=False)
+print(report.summary())
+report.save(args.report)
@@ -1,46 +1,89 @@
-import pandas as pd
+import argparse
+
 import numpy as np
-from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
-import tensorflow as tf
 from src.plot_training import plot_training_history, plot_auc
-
-df = pd.read_csv("data/processed/electron_dataset.csv")
-
-# print(df['target'].value_counts())
-
-X = df.drop(columns = ["target"]).to_numpy()
-
-y = df["target"].to_numpy()
-
-# Scale features to mean 0 and std 1 for stable and efficient training
-X = StandardScaler().fit_transform(X)
-
-X_train, X_test, y_train, y_test = train_test_split(
-    X, y, test_size=0.2, random_state=42
-)
-
-model = tf.keras.Sequential([
-    tf.keras.layers.Input(shape=(X.shape[1],)),
-    tf.keras.layers.Dense(64),
-    tf.keras.layers.LeakyReLU(),
-
-    tf.keras.layers.Dense(32),
-    tf.keras.layers.LeakyReLU(),
-
-    tf.keras.layers.Dense(16),
-    tf.keras.layers.LeakyReLU(),
-    tf.keras.layers.Dense(1, activation="sigmoid")
-])
+from src.dataset import (DATASET_PATH, LABEL_COLUMN, feature_columns, read_units, row_group_units, split_units,
+                         save_split, save_scaler, stored_moments)
+from src.instrumentation import RunReport, epoch_throughput_callback
+from src.model import build_model
+from src.training import full_history, resumed_epoch, training_callbacks
+
+parser = argparse.ArgumentParser(description="Train the electron classifier")
+parser.add_argument("--tf-data", action="store_true",
+                    help="Stream the Parquet row groups through tf.data instead of loading the dataset into memory")
+parser.add_argument("--shuffle-buffer", type=int, default=100_000, help="Shuffle buffer size in events for --tf-data")
+parser.add_argument("--epochs", type=int, default=30, help="Maximum number of epochs")
+parser.add_argument("--patience", type=int, default=5,
+                    help="Stop after this many epochs without a better validation AUC, the best epoch's weights are kept")
+parser.add_argument("--checkpoint-dir", default="results/checkpoints",
+                    help="Latest weights and optimizer state after every epoch, an interrupted run resumes from here")
+parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an interrupted run and start from epoch 1")
+parser.add_argument("--log", default="results/training_log.csv", help="CSV log of the metrics of every epoch")
+parser.add_argument("--report", default="results/train_report.json", help="JSON run report with per-stage timing and memory")
+args = parser.parse_args()
+
+report = RunReport("train")
+
+features = feature_columns(DATASET_PATH)
+
+# Split by Parquet row groups. The assignment is saved next to the model so
+# 3_evaluate.py reads exactly the test row groups and nothing else.
+split = split_units(row_group_units(DATASET_PATH), test_size=0.2, val_size=0.2, seed=42)
+save_split("results/split_manifest.json", split, dataset=DATASET_PATH, test_size=0.2, val_size=0.2, seed=42)
+
+if args.tf_data:
+    from src.input_pipeline import feature_moments, make_tf_dataset
+
+    # Standardization statistics of the training rows, merged from the row
+    # group statistics of the prepare step or else from one streaming pass
+    with report.stage("scale"):
+        moments = stored_moments(split["train"], features, DATASET_PATH)
+        mean, scale = moments if moments is not None else feature_moments(split["train"], features)
+
+    train_data = make_tf_dataset(split["train"], features, mean, scale, batch_size=128,
+                                 shuffle_buffer=args.shuffle_buffer)
+    val_data = make_tf_dataset(split["val"], features, mean, scale, batch_size=128)
+    n_train = sum(rows for _, _, rows in split["train"])
+else:
+    with report.stage("load"):
+        df_train = read_units(split["train"], columns=features + [LABEL_COLUMN])
+        df_val = read_units(split["val"], columns=features + [LABEL_COLUMN])
+
+    # print(df_train['target'].value_counts())
+
+    # float32 features and uint8 labels as stored, no float64 copies
+    X_train = df_train[features].to_numpy(dtype=np.float32)
+    y_train = df_train[LABEL_COLUMN].to_numpy()
+
+    X_val = df_val[features].to_numpy(dtype=np.float32)
+    y_val = df_val[LABEL_COLUMN].to_numpy()
+    n_train = len(X_train)
+
+    # Scale features to mean 0 and std 1 for stable and efficient training,
+    # with the statistics of the training rows only. They are merged from the
+    # row group statistics stored by the prepare step, without another pass
+    # over the data; datasets without them fall back to a StandardScaler fit.
+    with report.stage("scale"):
+        moments = stored_moments(split["train"], features, DATASET_PATH)
+        if moments is None:
+            scaler = StandardScaler().fit(X_train)
+            moments = scaler.mean_, scaler.scale_
+        mean, scale = moments
+
+        # In place, in float32
+        for X in (X_train, X_val):
+            X -= mean.astype(np.float32)
+            X /= scale.astype(np.float32)
+
+save_scaler("results/scaler.json", features, mean, scale)
+
+# 64-32-16 LeakyReLU layers, Adam with learning rate 1e-3
+# (scripts/sweep.py compares other choices)
+model = build_model(len(features), hidden=(64, 32, 16), learning_rate=0.001)
 
 model.summary()
 
-model.compile(
-    optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
-    loss="binary_crossentropy",
-    metrics=["accuracy", tf.keras.metrics.AUC(name="auc")]
-)
-
 ##############################################################
 # Handling class imbalance (optional for balanced datasets) #
 ##############################################################
@@ -66,21 +109,48 @@ model.compile(
 #     y_train, 
 #     epochs=30, 
 #     batch_size=128, 
-#     validation_split=0.2, 
+#     validation_data=(X_val, y_val), 
 #     class_weight=class_weights_dict
 # )
 
-history = model.fit(
-    X_train,
-    y_train,
-    epochs=30,
-    batch_size=128,
-    validation_split=0.2,
-    verbose = 2
-)
+# Records samples/s of every epoch in the run report
+throughput = epoch_throughput_callback(report, n_train)
+
+# Early stopping on the validation AUC, restoring the weights of the best
+# epoch, and a checkpoint after every epoch so a killed job resumes there
+callbacks = training_callbacks(args.checkpoint_dir, args.log, monitor="val_auc", patience=args.patience,
+                               restart=args.restart)
+if resumed_epoch(args.checkpoint_dir) > 0:
+    print(f"Resuming after epoch {resumed_epoch(args.checkpoint_dir)} from {args.checkpoint_dir}")
+
+with report.stage("train"):
+    if args.tf_data:
+        history = model.fit(
+            train_data,
+            validation_data=val_data,
+            epochs=args.epochs,
+            verbose = 2,
+            callbacks=[throughput] + callbacks
+        )
+    else:
+        history = model.fit(
+            X_train,
+            y_train,
+            epochs=args.epochs,
+            batch_size=128,
+            validation_data=(X_val, y_val),
+            verbose = 2,
+            callbacks=[throughput] + callbacks
+        )
 
 model.save("results/electron_classifier.h5")
 
+# Epochs of earlier interrupted attempts are in the log, not in history
+history = full_history(history, args.log)
+
+print(report.summary())
+report.save(args.report)
+
 plot_training_history(history, save_path="results/training_plot.png")
 
 plot_auc(history, save_path="results/auc_plot.png")
\ No newline at end of file
@@ -1,26 +1,78 @@
-import pandas as pd
+import argparse
+import sys
+
 import matplotlib.pyplot as plt
-import tensorflow as tf
+import numpy as np
 
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import roc_curve, auc
 
-df = pd.read_csv("data/processed/electron_dataset.csv")
+from src.dataset import LABEL_COLUMN, load_split, load_scaler, read_units
+from src.inference import load_predictor, score_dataset
+from src.metrics import ScoreHistogram, roc_approximation_error
+from src.instrumentation import RunReport
+
+parser = argparse.ArgumentParser(description="Evaluate the electron classifier or score a processed dataset")
+parser.add_argument("--backend", choices=["keras", "graph", "tflite"], default="keras",
+                    help="Inference backend: Keras, XLA compiled graph or quantized TFLite")
+parser.add_argument("--model", default="results/electron_classifier.h5", help="Saved model (.h5, or .tflite with --backend tflite)")
+parser.add_argument("--score-dataset", default=None, help="Score every event of this processed dataset instead of evaluating")
+parser.add_argument("--score-output", default="results/scores.parquet", help="Output Parquet file of --score-dataset")
+parser.add_argument("--batch-size", type=int, default=65536, help="Events per inference batch")
+parser.add_argument("--roc-bins", type=int, default=10000, help="Bins of the streaming score histograms")
+parser.add_argument("--report", default="results/evaluate_report.json", help="JSON run report with per-stage timing and memory")
+args = parser.parse_args()
+
+report = RunReport("evaluate")
+
+# Only the test row groups of the training split are read, and they are
+# standardized with the scaler fitted during training. Everything stays
+# float32 (features) and uint8 (labels) as stored in the dataset.
+features, mean, scale = load_scaler("results/scaler.json")
+mean = mean.astype(np.float32)
+scale = scale.astype(np.float32)
+
+with report.stage("load_model"):
+    predict = load_predictor(args.model, backend=args.backend)
 
-X = df.drop(columns=["target"]).to_numpy()
-y = df["target"].to_numpy()
+if args.score_dataset is not None:
+    hist = ScoreHistogram(args.roc_bins)
+    with report.stage("score"):
+        n_events, seconds = score_dataset(args.score_dataset, predict, features, mean, scale, args.score_output,
+                                          batch_size=args.batch_size, histogram=hist)
+    report.add("score", events=n_events, predict_s=seconds, events_per_s=n_events / max(seconds, 1e-9))
+    print(f"Scored {n_events} events in {seconds:.2f} s ({n_events / max(seconds, 1e-9):.0f} events/s), "
+          f"saved to {args.score_output}")
 
-X = StandardScaler().fit_transform(X)
+    # Labelled datasets also get a streaming AUC; the saved histograms of
+    # several scoring jobs can be merged with ScoreHistogram.load(...) + ...
+    if hist.signal.sum() > 0 and hist.background.sum() > 0:
+        hist.save(args.score_output.replace(".parquet", "") + "_histogram.npz")
+        print(f"Streaming AUC = {hist.auc():.4f}")
 
-X_train, X_test, y_train, y_test = train_test_split(
-    X, y, test_size=0.2, random_state=42
-)
+    print(report.summary())
+    report.save(args.report)
+    sys.exit(0)
 
-model = tf.keras.models.load_model("results/electron_classifier.h5")
+split = load_split("results/split_manifest.json")
 
-# Predicts probabilities and flattens 2D array to 1D
-y_scores = model.predict(X_test).ravel()
+with report.stage("load"):
+    df = read_units(split["test"], columns=features + [LABEL_COLUMN])
+
+    X_test = (df[features].to_numpy(dtype=np.float32) - mean) / scale
+    y_test = df[LABEL_COLUMN].to_numpy()
+
+# Predicts probabilities in batches, flattened to 1D, and fills the
+# streaming signal/background score histograms along the way
+hist = ScoreHistogram(args.roc_bins)
+y_scores = []
+with report.stage("predict"):
+    for i in range(0, len(X_test), args.batch_size):
+        scores = predict(X_test[i:i + args.batch_size])
+        hist.fill(scores, y_test[i:i + args.batch_size])
+        y_scores.append(scores)
+    y_scores = np.concatenate(y_scores)
+report.add("predict", events=len(X_test))
+hist.save("results/score_histogram.npz")
 
 # Compute the False Positive Rate (FPR) and True Positive Rate (TPR)
 # for various probability thresholds. This is used to create the ROC curve.
@@ -32,6 +84,17 @@ fpr, tpr, thresholds = roc_curve(y_test, y_scores)
 # - 0.5  -> random guessing
 roc_auc = auc(fpr, tpr)
 
+# How well the binned (mergeable) ROC reproduces the exact one
+error = roc_approximation_error(hist, y_test, y_scores)
+print(f"AUC exact = {error['exact_auc']:.5f}, histogram = {error['histogram_auc']:.5f} "
+      f"(|error| = {error['auc_error']:.2e}, max TPR error = {error['max_tpr_error']:.2e})")
+for eff in (0.5, 0.7, 0.9):
+    threshold, sig_eff, bkg_eff = hist.working_point(eff)
+    print(f"Working point: score > {threshold:.4f}, signal efficiency {sig_eff:.3f}, background efficiency {bkg_eff:.4f}")
+
+print(report.summary())
+report.save(args.report)
+
 plt.figure()
 plt.plot(fpr, tpr, lw=2, label=f"ROC curve (AUC = {roc_auc:.3f})")
 plt.plot([0, 1], [0, 1], linestyle="--", label="Random classifier")
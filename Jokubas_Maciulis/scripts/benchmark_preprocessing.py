@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import awkward as ak
+import numpy as np
+import pandas as pd
+
+from src.preprocessing import (TARGET_DTYPE, EventFeatures, _read_files, branches_for_specs, default_specs, event_features,
+                               flatten_electrons, flatten_jets, flatten_collections, load_dataset_from_txt,
+                               iterate_dataset_from_txt)
+from src.dataset import write_sample_shards
+from src.synthetic import write_synthetic_index
+from src.instrumentation import peak_rss_mb
+
+parser = argparse.ArgumentParser(description="Offline throughput benchmark of the prepare stage on synthetic NanoAOD files")
+parser.add_argument("--files", type=int, default=4, help="Number of synthetic ROOT files")
+parser.add_argument("--events", type=int, default=100_000, help="Events per file")
+parser.add_argument("--workers", type=int, default=1, help="Workers for the parallel read")
+parser.add_argument("--step-size", type=int, default=50_000, help="Entries per chunk for the streaming read")
+parser.add_argument("--data-dir", default=None, help="Where to write the synthetic files (default: a temporary directory)")
+parser.add_argument("--json", default=None, help="Also save the results to this JSON file")
+args = parser.parse_args()
+
+results = []
+
+def timed(stage, n_events, fn):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    results.append({
+        "stage": stage,
+        "seconds": elapsed,
+        "events_per_s": n_events / elapsed if elapsed > 0 else float("inf"),
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    return result
+
+data_dir = args.data_dir or tempfile.mkdtemp(prefix="synthetic_nanoaod_")
+n_events = args.files * args.events
+
+index = timed("generate", n_events, lambda: write_synthetic_index(data_dir, args.files, args.events))
+files = np.atleast_1d(np.loadtxt(index, dtype=str))
+
+specs = default_specs()
+branches = branches_for_specs(specs)
+
+# Stages of load_dataset_from_txt, timed separately
+arrays = timed("read", n_events, lambda: _read_files(files, branches))
+data = timed("concatenate", n_events, lambda: ak.concatenate(arrays))
+
+timed("flatten_electrons", n_events, lambda: flatten_electrons(data))
+timed("flatten_jets", n_events, lambda: flatten_jets(data))
+timed("event_features", n_events, lambda: event_features(data, EventFeatures()))
+df = timed("flatten_collections", n_events, lambda: flatten_collections(data, specs))
+df["target"] = np.full(len(df), 1, dtype=TARGET_DTYPE)
+
+out_dir = os.path.join(data_dir, "processed")
+timed("write_parquet", n_events, lambda: write_sample_shards([df], out_dir, "synthetic"))
+
+# End to end
+if args.workers > 1:
+    timed(f"load_dataset_from_txt ({args.workers} workers)", n_events,
+          lambda: load_dataset_from_txt(index, 1, n_workers=args.workers))
+timed("load_dataset_from_txt", n_events, lambda: load_dataset_from_txt(index, 1))
+timed("iterate_dataset_from_txt", n_events,
+      lambda: sum(len(block) for block in iterate_dataset_from_txt(index, 1, step_size=args.step_size)))
+
+report = pd.DataFrame(results)
+print(f"{args.files} files x {args.events} events")
+print(report.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+# The derived features should cost a small fraction of reading the branches
+seconds = report.set_index("stage")["seconds"]
+print(f"event_features / read = {seconds['event_features'] / seconds['read']:.2f}")
+
+if args.json:
+    with open(args.json, "w") as f:
+        json.dump({"files": args.files, "events_per_file": args.events, "stages": results}, f, indent=2)
+
+if args.data_dir is None:
+    shutil.rmtree(data_dir)
@@ -0,0 +1,59 @@
+import argparse
+import glob
+import os
+import shlex
+import sys
+
+from src.build import Stage, run_stages
+from src.dataset import DATASET_PATH
+
+STAGES = ["prepare", "train", "evaluate"]
+
+parser = argparse.ArgumentParser(description="Run prepare, train and evaluate, skipping the stages that are up to date")
+parser.add_argument("--force", nargs="*", choices=STAGES, default=[], help="Run these stages even if they are up to date")
+parser.add_argument("--dry-run", action="store_true", help="Only print which stages would run")
+parser.add_argument("--prepare-args", default="", help="Extra arguments for 1_prepare_dataset, e.g. \"--workers 4\"")
+parser.add_argument("--train-args", default="", help="Extra arguments for 2_train")
+parser.add_argument("--evaluate-args", default="", help="Extra arguments for 3_evaluate")
+parser.add_argument("--stamp-dir", default="results/_stamps", help="Where the fingerprints of the last successful runs are kept")
+args = parser.parse_args()
+
+def command(script, extra):
+    return [sys.executable, "-m", f"scripts.{script}"] + shlex.split(extra)
+
+# The inputs of every stage: the data it reads, the code that defines it
+# (feature and branch specs, cuts, hyperparameters live in the scripts and
+# src modules) and its command line. The prepare output is an input of
+# train, the model and split of train are inputs of evaluate.
+model = ["results/electron_classifier.h5", "results/scaler.json", "results/split_manifest.json"]
+
+stages = [
+    Stage(
+        "prepare",
+        command("1_prepare_dataset", args.prepare_args),
+        inputs=sorted(glob.glob("data/raw/**/*_file_index.txt", recursive=True)) + [
+            "scripts/1_prepare_dataset.py", "src/preprocessing.py", "src/dataset.py", "src/incremental.py",
+            "src/stats.py", "src/instrumentation.py",
+        ],
+        outputs=[DATASET_PATH],
+    ),
+    Stage(
+        "train",
+        command("2_train", args.train_args),
+        inputs=[DATASET_PATH, "scripts/2_train.py", "src/model.py", "src/training.py", "src/dataset.py", "src/stats.py",
+                "src/input_pipeline.py", "src/plot_training.py"],
+        outputs=model,
+    ),
+    Stage(
+        "evaluate",
+        command("3_evaluate", args.evaluate_args),
+        inputs=model + [DATASET_PATH, "scripts/3_evaluate.py", "src/inference.py", "src/metrics.py"],
+        outputs=["results/roc_curve.png"],
+    ),
+]
+
+# Plots are saved to files, no window is opened
+env = dict(os.environ)
+env.setdefault("MPLBACKEND", "Agg")
+
+run_stages(stages, args.stamp_dir, force=args.force, dry_run=args.dry_run, env=env)
@@ -0,0 +1,65 @@
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from src.preprocessing import (RootFileCache, branches_for_specs, cutflow_table, default_specs, parse_step_size,
+                               preselection_cuts, probe_files, skim_dataset_from_txt)
+from src.dataset import sample_name_from_txt
+from src.instrumentation import RunReport
+
+RAW_DIR = "data/raw"
+
+parser = argparse.ArgumentParser(description="Write preselected events with only the needed branches to local ROOT skims")
+parser.add_argument("indices", nargs="*", help="File indices to skim (default: every *_file_index.txt under data/raw)")
+parser.add_argument("--output", default="data/skims", help="Skims and their file indices go here, mirroring data/raw")
+parser.add_argument("--min-electrons", type=int, default=0, help="Preselection: keep events with at least this many electrons")
+parser.add_argument("--min-lead-pt", type=float, default=None, help="Preselection: leading electron pT threshold in GeV")
+parser.add_argument("--extra-branches", nargs="*", default=[],
+                    help="Branches kept in addition to the ones of the default features, e.g. Electron_charge")
+parser.add_argument("--max-events", type=int, default=None, help="Events read per index (default: all)")
+parser.add_argument("--step-size", default="100 MB", help="Chunk size, number of entries or a size like '100 MB'")
+parser.add_argument("--cache-dir", default=None, help="Read local copies of the remote ROOT files from this directory")
+parser.add_argument("--offline", action="store_true", help="Read only from --cache-dir, never from EOS")
+parser.add_argument("--probe-workers", type=int, default=16, help="Files whose entry counts are fetched concurrently")
+parser.add_argument("--report", default="results/skim_report.json", help="JSON run report with per-stage timing and memory")
+args = parser.parse_args()
+
+indices = args.indices or sorted(glob.glob(os.path.join(RAW_DIR, "*", "*_file_index.txt")))
+
+cuts = preselection_cuts(args.min_electrons, args.min_lead_pt)
+
+branches = branches_for_specs(default_specs(), cuts)
+branches += [b for b in args.extra_branches if b not in branches]
+
+report = RunReport("skim")
+
+cache = None
+if args.cache_dir is not None:
+    cache = RootFileCache(args.cache_dir, offline=args.offline)
+
+with report.stage("probe"):
+    metadata = probe_files(np.concatenate([np.atleast_1d(np.loadtxt(f, dtype=str)) for f in indices]),
+                           n_workers=args.probe_workers, cache=cache)
+
+cutflows = {}
+for f in indices:
+    # data/raw/signal/X_file_index.txt -> data/skims/signal/X_file_index.txt,
+    # indices from elsewhere go directly into --output
+    subdir = os.path.relpath(os.path.dirname(os.path.abspath(f)), os.path.abspath(RAW_DIR))
+    out_dir = args.output if subdir.startswith("..") else os.path.join(args.output, subdir)
+
+    index = skim_dataset_from_txt(f, out_dir, branches, cuts=cuts, max_events=args.max_events,
+                                  step_size=parse_step_size(args.step_size),
+                                  cutflow=cutflows.setdefault(sample_name_from_txt(f), {}),
+                                  cache=cache, report=report, metadata=metadata)
+    print(f"{sample_name_from_txt(f)}: {index}")
+
+print(cutflow_table(cutflows).to_string())
+with open(os.path.join(args.output, "_cutflow.json"), "w") as f:
+    json.dump({"branches": branches, "cuts": [cut.name for cut in cuts], "cutflow": cutflows}, f, indent=2)
+
+print(report.summary())
+report.save(args.report)
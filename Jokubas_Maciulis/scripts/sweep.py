@@ -0,0 +1,72 @@
+import argparse
+import os
+
+import numpy as np
+from sklearn.preprocessing import StandardScaler
+
+from src.dataset import (DATASET_PATH, LABEL_COLUMN, feature_columns, read_units, row_group_units, split_units,
+                         stored_moments)
+from src.instrumentation import RunReport
+from src.sweep import expand_grid, run_sweep
+
+def hidden_layers(value):
+    return tuple(int(units) for units in value.split("-"))
+
+parser = argparse.ArgumentParser(description="Train a grid of model configurations in parallel and compare their validation AUC")
+parser.add_argument("--hidden", type=hidden_layers, nargs="+", default=[(64, 32, 16), (128, 64, 32), (32, 16)],
+                    help="Hidden layer sizes, e.g. 64-32-16 128-64")
+parser.add_argument("--learning-rate", type=float, nargs="+", default=[1e-3, 3e-4], help="Adam learning rates")
+parser.add_argument("--batch-size", type=int, nargs="+", default=[128, 512], help="Batch sizes")
+parser.add_argument("--epochs", type=int, default=30, help="Epochs per configuration")
+parser.add_argument("--workers", type=int, default=None, help="Parallel trainings (default: cores / threads)")
+parser.add_argument("--threads", type=int, default=1, help="TensorFlow threads per training")
+parser.add_argument("--output", default="results/sweep_results.csv", help="Results table, one row per configuration")
+parser.add_argument("--report", default="results/sweep_report.json", help="JSON run report with per-stage timing and memory")
+args = parser.parse_args()
+
+report = RunReport("sweep")
+
+features = feature_columns(DATASET_PATH)
+
+# Same split and scaling as 2_train.py, done once for the whole sweep
+split = split_units(row_group_units(DATASET_PATH), test_size=0.2, val_size=0.2, seed=42)
+
+with report.stage("load"):
+    df_train = read_units(split["train"], columns=features + [LABEL_COLUMN])
+    df_val = read_units(split["val"], columns=features + [LABEL_COLUMN])
+
+with report.stage("scale"):
+    arrays = {
+        "X_train": df_train[features].to_numpy(dtype=np.float32),
+        "y_train": df_train[LABEL_COLUMN].to_numpy(),
+        "X_val": df_val[features].to_numpy(dtype=np.float32),
+        "y_val": df_val[LABEL_COLUMN].to_numpy(),
+    }
+    moments = stored_moments(split["train"], features, DATASET_PATH)
+    if moments is None:
+        scaler = StandardScaler().fit(arrays["X_train"])
+        moments = scaler.mean_, scaler.scale_
+    for name in ("X_train", "X_val"):
+        arrays[name] -= moments[0].astype(np.float32)
+        arrays[name] /= moments[1].astype(np.float32)
+del df_train, df_val
+
+configs = expand_grid({
+    "hidden": args.hidden,
+    "learning_rate": args.learning_rate,
+    "batch_size": args.batch_size,
+    "epochs": [args.epochs],
+})
+print(f"{len(configs)} configurations on {len(arrays['X_train'])} training events")
+
+with report.stage("sweep"):
+    results = run_sweep(arrays, configs, n_workers=args.workers, threads_per_worker=args.threads)
+report.add("sweep", configurations=len(configs))
+
+print(results.to_string(index=False, float_format=lambda x: f"{x:.4g}"))
+
+os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+results.to_csv(args.output, index=False)
+
+print(report.summary())
+report.save(args.report)
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import subprocess
+import time
+from dataclasses import dataclass
+
+@dataclass
+class Stage:
+    # One step of the pipeline: the command that runs it, the files and
+    # directories it reads (data, code, configuration) and the ones it writes
+    name: str
+    command: list
+    inputs: list
+    outputs: list
+
+def _hash_path(path, digest):
+    # Files are hashed by content. Directories (the Parquet dataset) by the
+    # name, size and mtime of every file, which is cheap for large datasets.
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                st = os.stat(full)
+                digest.update(f"{os.path.relpath(full, path)}:{st.st_size}:{st.st_mtime_ns}\n".encode())
+    elif os.path.isfile(path):
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    else:
+        digest.update(b"<missing>")
+
+def fingerprint(stage):
+    # Hash of the command line and the current state of all inputs
+    digest = hashlib.sha256(json.dumps(stage.command).encode())
+    for path in sorted(stage.inputs):
+        digest.update(f"\n{path}\n".encode())
+        _hash_path(path, digest)
+    return digest.hexdigest()
+
+def _stamp_path(stamp_dir, stage):
+    return os.path.join(stamp_dir, f"{stage.name}.json")
+
+def is_up_to_date(stage, key, stamp_dir):
+    # Up to date when the last successful run saw the same inputs and all
+    # outputs are still there
+    path = _stamp_path(stamp_dir, stage)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        stamp = json.load(f)
+    return stamp["fingerprint"] == key and all(os.path.exists(output) for output in stage.outputs)
+
+def run_stages(stages, stamp_dir, force=(), dry_run=False, env=None):
+    # Runs the stages in order, skipping the ones that are up to date. The
+    # fingerprint of a stage is taken right before it runs, so the outputs of
+    # a stage that just ran are seen by the next one. Returns the names of
+    # the stages that ran (or would run with dry_run).
+    ran = []
+    for stage in stages:
+        key = fingerprint(stage)
+        # In a dry run the outputs of an earlier stage would change, so
+        # everything after a stale stage is stale as well
+        stale = stage.name in force or not is_up_to_date(stage, key, stamp_dir) or (dry_run and bool(ran))
+        if not stale:
+            print(f"[{stage.name}] up to date")
+            continue
+
+        ran.append(stage.name)
+        print(f"[{stage.name}] {'would run' if dry_run else 'running'}: {' '.join(stage.command)}")
+        if dry_run:
+            continue
+
+        start = time.time()
+        result = subprocess.run(stage.command, env=env)
+        if result.returncode != 0:
+            raise SystemExit(f"[{stage.name}] failed with exit code {result.returncode}")
+
+        os.makedirs(stamp_dir, exist_ok=True)
+        with open(_stamp_path(stamp_dir, stage), "w") as f:
+            json.dump({"fingerprint": key, "command": stage.command, "seconds": time.time() - start}, f, indent=2)
+        print(f"[{stage.name}] done in {time.time() - start:.1f} s")
+
+    return ran
@@ -0,0 +1,369 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+
+from src.instrumentation import stage
+from src.stats import FeatureStats
+
+DATASET_PATH = "data/processed/electron_dataset"
+
+# Manifest of incremental builds, see src/incremental.py
+MANIFEST_NAME = "_manifest.json"
+
+# Feature statistics of every row group, written by the prepare step
+STATS_NAME = "_feature_stats.json"
+
+# Columns that are not model inputs
+LABEL_COLUMN = "target"
+SAMPLE_COLUMN = "sample"
+
+def sample_name_from_txt(txt_file):
+    # "CMS_mc_RunIISummer20UL16NanoAODv9_TTJets_TuneCP5_..._file_index.txt" -> "TTJets"
+    name = os.path.basename(txt_file)
+    name = name.replace("_file_index.txt", "")
+    name = name.split("NanoAODv9_", 1)[-1]
+    return name.split("_TuneCP5", 1)[0]
+
+class DatasetStats:
+    # FeatureStats of every row group of a dataset, keyed by the file path
+    # relative to the dataset directory. They are computed by the writers on
+    # the tables they write, so the statistics of any set of row groups (e.g.
+    # the training split) are a merge away, without reading the data again.
+    def __init__(self, features=None):
+        self.features = features
+        self.row_groups = {}
+
+    def add_table(self, path, table, row_group_size):
+        # table was written to path with row_group_size, appended after the
+        # row groups already recorded for path
+        if self.features is None:
+            self.features = [c for c in table.column_names if c not in (LABEL_COLUMN, SAMPLE_COLUMN)]
+        groups = self.row_groups.setdefault(path, [])
+        for start in range(0, table.num_rows, row_group_size):
+            chunk = table.slice(start, row_group_size)
+            X = np.column_stack([chunk.column(c).to_numpy() for c in self.features])
+            groups.append(FeatureStats(len(self.features)).update(X))
+
+    def merge_units(self, units, dataset_path=DATASET_PATH):
+        # Merged stats of (path, row group, rows) units as made by row_group_units
+        merged = FeatureStats(len(self.features))
+        for path, row_group, rows in units:
+            stats = self.row_groups[os.path.relpath(path, dataset_path)][row_group]
+            if stats.count != rows:
+                raise ValueError(f"Feature statistics of {path} row group {row_group} do not match the file")
+            merged = merged + stats
+        return merged
+
+    def total(self):
+        merged = FeatureStats(len(self.features))
+        for groups in self.row_groups.values():
+            for stats in groups:
+                merged = merged + stats
+        return merged
+
+    def table(self):
+        stats = self.total()
+        return pd.DataFrame({
+            "feature": self.features, "mean": stats.mean, "std": np.sqrt(stats.variance),
+            "min": stats.min, "max": stats.max, "zero_fraction": stats.zero_fraction,
+        })
+
+    def save(self, out_dir):
+        with open(os.path.join(out_dir, STATS_NAME), "w") as f:
+            json.dump({
+                "features": self.features,
+                "row_groups": {path: [stats.to_dict() for stats in groups] for path, groups in self.row_groups.items()},
+            }, f)
+
+    @classmethod
+    def load(cls, dataset_path=DATASET_PATH):
+        # None for datasets written without statistics
+        path = os.path.join(dataset_path, STATS_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            values = json.load(f)
+        stats = cls(values["features"])
+        stats.row_groups = {path: [FeatureStats.from_dict(v) for v in groups]
+                            for path, groups in values["row_groups"].items()}
+        return stats
+
+def stored_moments(units, features, dataset_path=DATASET_PATH):
+    # (mean, scale) of the features over units from the statistics stored
+    # with the dataset, or None if it has none for these features
+    stats = DatasetStats.load(dataset_path)
+    if stats is None or stats.features != list(features):
+        return None
+    merged = stats.merge_units(units, dataset_path)
+    return merged.mean, merged.scale
+
+def write_sample_shards(blocks, out_dir, sample, row_group_size=10_000, rows_per_shard=1_000_000,
+                        compression="zstd", report=None, stats=None):
+    # Writes an iterable of DataFrame blocks to out_dir/sample=<sample>/part-XXXXX.parquet.
+    # Small blocks are buffered so every row group (except the last) holds
+    # row_group_size rows, which is the unit readers stream over. A
+    # DatasetStats as stats collects the statistics of every row group.
+    sample_dir = os.path.join(out_dir, f"{SAMPLE_COLUMN}={sample}")
+    if os.path.exists(sample_dir):
+        shutil.rmtree(sample_dir)
+    os.makedirs(sample_dir)
+
+    writer = None
+    path = None
+    shard = 0
+    shard_rows = 0
+    buffer = []
+    buffered = 0
+    written = 0
+
+    def flush(tables):
+        nonlocal writer, path, shard, shard_rows, written
+        with stage(report, "write"):
+            table = pa.concat_tables(tables)
+            if writer is None:
+                path = os.path.join(sample_dir, f"part-{shard:05d}.parquet")
+                writer = pq.ParquetWriter(path, table.schema, compression=compression)
+            writer.write_table(table, row_group_size=row_group_size)
+            shard_rows += table.num_rows
+            written += table.num_rows
+            if shard_rows >= rows_per_shard:
+                writer.close()
+                writer = None
+                shard += 1
+                shard_rows = 0
+
+        if stats is not None:
+            with stage(report, "stats"):
+                stats.add_table(os.path.relpath(path, out_dir), table, row_group_size)
+
+    for block in blocks:
+        buffer.append(pa.Table.from_pandas(block, preserve_index=False))
+        buffered += len(block)
+        if buffered >= row_group_size:
+            table = pa.concat_tables(buffer)
+            n_full = (table.num_rows // row_group_size) * row_group_size
+            flush([table.slice(0, n_full)])
+            buffer = [table.slice(n_full)]
+            buffered = table.num_rows - n_full
+
+    if buffered > 0:
+        flush(buffer)
+    if writer is not None:
+        writer.close()
+
+    return written
+
+def clear_dataset(out_dir):
+    # Removes the shards of a previous build, whichever layout it used
+    for path in glob.glob(os.path.join(out_dir, f"{SAMPLE_COLUMN}=*")) + [os.path.join(out_dir, "_spill")]:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    for path in glob.glob(os.path.join(out_dir, "part-*.parquet")) + [os.path.join(out_dir, MANIFEST_NAME),
+                                                                     os.path.join(out_dir, STATS_NAME)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+class ShuffledShardWriter:
+    # Out-of-core shuffle. Rows of every incoming block are spread over
+    # n_buckets on-disk spill files by a seeded random draw, and close()
+    # shuffles each bucket in memory on its own and writes it as
+    # out_dir/part-XXXXX.parquet. The result is a global shuffle that needs
+    # memory for one bucket only and is reproducible from the seed, given the
+    # same blocks in the same order. The sample name is kept as a column.
+    def __init__(self, out_dir, n_buckets=16, seed=42, row_group_size=10_000, compression="zstd", report=None,
+                 stats=None):
+        self.out_dir = out_dir
+        self.report = report
+        self.stats = stats
+        self.n_buckets = n_buckets
+        self.seed = seed
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.rng = np.random.default_rng(seed)
+
+        clear_dataset(out_dir)
+        self.spill_dir = os.path.join(out_dir, "_spill")
+        os.makedirs(self.spill_dir)
+        self.writers = [None] * n_buckets
+
+    def _spill_path(self, bucket):
+        return os.path.join(self.spill_dir, f"bucket-{bucket:05d}.parquet")
+
+    def add(self, df, sample=None):
+        with stage(self.report, "shuffle"):
+            self._add(df, sample)
+
+    def _add(self, df, sample):
+        if sample is not None:
+            df = df.assign(**{SAMPLE_COLUMN: sample})
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        buckets = self.rng.integers(0, self.n_buckets, table.num_rows)
+        order = np.argsort(buckets, kind="stable")
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(buckets, minlength=self.n_buckets))])
+
+        for bucket in range(self.n_buckets):
+            if bounds[bucket] == bounds[bucket + 1]:
+                continue
+            if self.writers[bucket] is None:
+                self.writers[bucket] = pq.ParquetWriter(self._spill_path(bucket), table.schema, compression="lz4")
+            self.writers[bucket].write_table(table.take(order[bounds[bucket]:bounds[bucket + 1]]))
+
+    def close(self):
+        written = 0
+        for bucket, writer in enumerate(self.writers):
+            if writer is None:
+                continue
+            writer.close()
+
+            with stage(self.report, "shuffle"):
+                table = pq.read_table(self._spill_path(bucket))
+                perm = np.random.default_rng([self.seed, bucket]).permutation(table.num_rows)
+                table = table.take(perm)
+
+            name = f"part-{bucket:05d}.parquet"
+            with stage(self.report, "write"):
+                pq.write_table(table, os.path.join(self.out_dir, name),
+                               row_group_size=self.row_group_size, compression=self.compression)
+            if self.stats is not None:
+                with stage(self.report, "stats"):
+                    self.stats.add_table(name, table, self.row_group_size)
+            written += table.num_rows
+
+        shutil.rmtree(self.spill_dir)
+        return written
+
+def open_dataset(path=DATASET_PATH):
+    return pds.dataset(path, format="parquet", partitioning="hive")
+
+def feature_columns(path=DATASET_PATH):
+    names = open_dataset(path).schema.names
+    return [c for c in names if c not in (LABEL_COLUMN, SAMPLE_COLUMN)]
+
+def read_dataset(path=DATASET_PATH, columns=None):
+    # Only the requested columns are decoded from the files
+    return open_dataset(path).to_table(columns=columns).to_pandas()
+
+def iter_batches(path=DATASET_PATH, columns=None, batch_size=100_000):
+    # Streams the dataset as DataFrames without loading it into memory
+    for batch in open_dataset(path).to_batches(columns=columns, batch_size=batch_size):
+        if batch.num_rows > 0:
+            yield batch.to_pandas()
+
+def row_group_units(path=DATASET_PATH):
+    # Every (file, row group, rows) of the dataset, in dataset order. Row groups
+    # are the smallest unit that can be read on its own, so splits are made of them.
+    units = []
+    for fragment in open_dataset(path).get_fragments():
+        metadata = pq.ParquetFile(fragment.path).metadata
+        for i in range(metadata.num_row_groups):
+            units.append((fragment.path, i, metadata.row_group(i).num_rows))
+    return units
+
+def split_units(units, test_size=0.2, val_size=0.2, seed=42):
+    # Row groups are shuffled within every file and then dealt out file after
+    # file with running credits, so the splits get test_size and val_size of
+    # the row groups overall and each file (and therefore each sample) is
+    # spread over them even if it only has a few row groups.
+    # val_size is a fraction of what is left after the test split.
+    rng = np.random.default_rng(seed)
+    split = {"train": [], "val": [], "test": []}
+
+    by_file = {}
+    for unit in units:
+        by_file.setdefault(unit[0], []).append(unit)
+
+    test_credit, val_credit = rng.random(2)
+    for path in sorted(by_file):
+        file_units = by_file[path]
+        for i in rng.permutation(len(file_units)):
+            test_credit += test_size
+            val_credit += (1 - test_size) * val_size
+            if test_credit >= 1:
+                split["test"].append(file_units[i])
+                test_credit -= 1
+            elif val_credit >= 1:
+                split["val"].append(file_units[i])
+                val_credit -= 1
+            else:
+                split["train"].append(file_units[i])
+
+    for name in split:
+        split[name].sort()
+    return split
+
+def read_units(units, columns=None):
+    # Reads only the listed row groups
+    tables = []
+    by_file = {}
+    for path, row_group, _ in units:
+        by_file.setdefault(path, []).append(row_group)
+    for path, row_groups in by_file.items():
+        tables.append(pq.ParquetFile(path).read_row_groups(row_groups, columns=columns))
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    return pa.concat_tables(tables).to_pandas()
+
+def _footer_digest(path):
+    # Hash of the Parquet footer (row groups, column statistics, compressed
+    # sizes), which changes when a file is rewritten with other rows even if
+    # its row counts stay the same
+    metadata = pq.ParquetFile(path).metadata.to_dict()
+    return hashlib.sha256(json.dumps(metadata, sort_keys=True, default=str).encode()).hexdigest()
+
+def save_split(path, split, **info):
+    # Exact row group assignment of a training run, plus how it was made and
+    # a digest of every file, so a later rebuild of the dataset is detected
+    manifest = dict(info)
+    manifest["units"] = {name: [list(unit) for unit in units] for name, units in split.items()}
+    files = sorted({unit[0] for units in split.values() for unit in units})
+    manifest["files"] = {f: _footer_digest(f) for f in files}
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+def load_split(path):
+    # Raises ValueError if the dataset no longer holds the row groups of the
+    # manifest: a file is missing, outside the recorded dataset, has another
+    # number of rows in a row group or was rewritten since training
+    with open(path) as f:
+        manifest = json.load(f)
+    split = {name: [tuple(unit) for unit in units] for name, units in manifest["units"].items()}
+
+    dataset = manifest.get("dataset")
+    digests = manifest.get("files", {})
+    num_rows = {}
+    for units in split.values():
+        for file_path, row_group, rows in units:
+            if dataset is not None and os.path.commonpath(
+                    [os.path.abspath(file_path), os.path.abspath(dataset)]) != os.path.abspath(dataset):
+                raise ValueError(f"{path}: {file_path} is not in the dataset {dataset} it was made for")
+            if file_path not in num_rows:
+                if not os.path.exists(file_path):
+                    raise ValueError(f"{path}: {file_path} no longer exists, the dataset was rebuilt since training")
+                if file_path in digests and _footer_digest(file_path) != digests[file_path]:
+                    raise ValueError(f"{path}: {file_path} was rewritten since training, retrain on the new dataset")
+                metadata = pq.ParquetFile(file_path).metadata
+                num_rows[file_path] = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+            if row_group >= len(num_rows[file_path]) or num_rows[file_path][row_group] != rows:
+                raise ValueError(f"{path}: row group {row_group} of {file_path} no longer has {rows} rows, "
+                                 f"the dataset was rebuilt since training")
+
+    return split
+
+def save_scaler(path, features, mean, scale):
+    with open(path, "w") as f:
+        json.dump({"features": list(features), "mean": list(map(float, mean)), "scale": list(map(float, scale))}, f, indent=2)
+
+def load_scaler(path):
+    # Returns (features, mean, scale); X is standardized as (X - mean) / scale
+    with open(path) as f:
+        scaler = json.load(f)
+    return scaler["features"], np.array(scaler["mean"]), np.array(scaler["scale"])
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.dataset import MANIFEST_NAME, SAMPLE_COLUMN, DatasetStats, clear_dataset
+from src.stats import FeatureStats
+from src.instrumentation import stage
+from src.preprocessing import file_fingerprint, load_file
+
+# Incremental builds write one shard per input ROOT file,
+# <out_dir>/sample=<name>/file-<hash>.parquet, and record in the manifest for
+# every input file its fingerprint, the entries read, the output shard and the
+# settings it was built with. A rerun only reads files that are new, changed
+# or need a different number of entries, so an interrupted build resumes
+# where it stopped and a file appended to an index costs one file.
+
+def settings_key(**settings):
+    # Short hash of everything that changes the content of a shard
+    text = repr(sorted(settings.items()))
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(out_dir, manifest):
+    # Written to a temporary file and renamed, so a crash never leaves a broken manifest
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+def open_manifest(out_dir):
+    # The manifest of out_dir, or a fresh one after clearing any dataset
+    # that was not built incrementally
+    manifest = load_manifest(out_dir)
+    if manifest is None:
+        os.makedirs(out_dir, exist_ok=True)
+        clear_dataset(out_dir)
+        manifest = {"files": {}}
+    return manifest
+
+def _shard_name(sample, file_path):
+    key = hashlib.sha256(file_path.encode()).hexdigest()[:16]
+    return os.path.join(f"{SAMPLE_COLUMN}={sample}", f"file-{key}.parquet")
+
+def _write_shard(df, path, row_group_size, compression):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, tmp, row_group_size=row_group_size, compression=compression)
+    os.replace(tmp, path)
+    return table
+
+def build_sample_incremental(txt_file, target_label, out_dir, sample, manifest, settings, max_events=None,
+                             row_group_size=10_000, compression="zstd", cutflow=None, report=None, **load_kwargs):
+    # Brings the shards of one file index up to date. The quota max_events is
+    # filled in index order like load_dataset_from_txt does. Returns the input
+    # files that belong to the dataset and the number of files (re)built.
+    files = np.atleast_1d(np.loadtxt(txt_file, dtype=str))
+
+    kept = []
+    built = 0
+    loaded = 0
+
+    for file_path in files:
+        file_path = str(file_path)
+        if max_events is not None and loaded >= max_events:
+            break
+
+        with stage(report, "open"):
+            fingerprint = file_fingerprint(file_path, load_kwargs.get("cache"))
+
+        entry_stop = fingerprint["num_entries"]
+        if max_events is not None:
+            entry_stop = min(entry_stop, max_events - loaded)
+
+        entry = manifest["files"].get(file_path)
+        up_to_date = (
+            entry is not None
+            and entry["fingerprint"] == fingerprint
+            and entry["entries_read"] == entry_stop
+            and entry["settings"] == settings
+            and entry["sample"] == sample
+            and entry["target"] == target_label
+            and "stats" in entry
+            and os.path.exists(os.path.join(out_dir, entry["shard"]))
+        )
+
+        if not up_to_date:
+            file_cutflow = {}
+            df = load_file(file_path, target_label, entry_stop=entry_stop, cutflow=file_cutflow, report=report,
+                           **load_kwargs)
+
+            shard = _shard_name(sample, file_path)
+            with stage(report, "write"):
+                table = _write_shard(df, os.path.join(out_dir, shard), row_group_size, compression)
+
+            with stage(report, "stats"):
+                stats = DatasetStats()
+                stats.add_table(shard, table, row_group_size)
+
+            entry = {
+                "sample": sample,
+                "target": target_label,
+                "fingerprint": fingerprint,
+                "entries_read": entry_stop,
+                "rows": len(df),
+                "shard": shard,
+                "settings": settings,
+                "cutflow": file_cutflow,
+                "stats": {"features": stats.features, "row_groups": [g.to_dict() for g in stats.row_groups[shard]]},
+            }
+            manifest["files"][file_path] = entry
+            # Saved after every file, so a crash loses at most the file being read
+            save_manifest(out_dir, manifest)
+            built += 1
+
+        if cutflow is not None:
+            for name, count in entry["cutflow"].items():
+                cutflow[name] = cutflow.get(name, 0) + count
+
+        loaded += entry["entries_read"]
+        kept.append(file_path)
+
+    return kept, built
+
+def prune_manifest(out_dir, manifest, kept):
+    # Removes the shards of input files that are no longer part of the dataset
+    # (dropped from an index, or beyond the quota)
+    kept = set(kept)
+    for file_path in list(manifest["files"]):
+        if file_path not in kept:
+            shard = os.path.join(out_dir, manifest["files"][file_path]["shard"])
+            if os.path.exists(shard):
+                os.remove(shard)
+            del manifest["files"][file_path]
+    save_manifest(out_dir, manifest)
+
+def manifest_stats(manifest):
+    # DatasetStats of all shards in the manifest
+    stats = DatasetStats()
+    for entry in manifest["files"].values():
+        stats.features = entry["stats"]["features"]
+        stats.row_groups[entry["shard"]] = [FeatureStats.from_dict(g) for g in entry["stats"]["row_groups"]]
+    return stats
@@ -0,0 +1,131 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow as tf
+
+from src.dataset import LABEL_COLUMN, SAMPLE_COLUMN, iter_batches, open_dataset
+
+def export_tflite(model, out_path=None, quantize=True):
+    # Converts a Keras model to TFLite, with dynamic range (int8 weight)
+    # quantization by default
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    content = converter.convert()
+
+    if out_path is not None:
+        with open(out_path, "wb") as f:
+            f.write(content)
+
+    return content
+
+def _tflite_predict(content):
+    interpreter = tf.lite.Interpreter(model_content=content)
+    input_index = interpreter.get_input_details()[0]["index"]
+    output_index = interpreter.get_output_details()[0]["index"]
+    shape = None
+
+    def predict(X):
+        nonlocal shape
+        # Tensors are only reallocated when the batch size changes
+        if X.shape != shape:
+            interpreter.resize_tensor_input(input_index, X.shape)
+            interpreter.allocate_tensors()
+            shape = X.shape
+        interpreter.set_tensor(input_index, X)
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index).ravel()
+
+    return predict
+
+def load_predictor(model_path, backend="keras", quantize=True):
+    # Returns predict(X) -> scores for float32 batches.
+    # "keras":  model.predict_on_batch
+    # "graph":  the model traced once into an XLA compiled tf.function
+    # "tflite": the model converted to (quantized) TFLite and run by the TFLite interpreter,
+    #           a .tflite model_path is loaded as is
+    if backend == "tflite" and model_path.endswith(".tflite"):
+        with open(model_path, "rb") as f:
+            return _tflite_predict(f.read())
+
+    model = tf.keras.models.load_model(model_path, compile=False)
+
+    if backend == "keras":
+        return lambda X: model.predict_on_batch(X).ravel()
+
+    if backend == "graph":
+        n_features = model.inputs[0].shape[-1]
+
+        @tf.function(input_signature=[tf.TensorSpec([None, n_features], tf.float32)], jit_compile=True)
+        def graph(X):
+            return model(X, training=False)
+
+        return lambda X: graph(X).numpy().ravel()
+
+    if backend == "tflite":
+        return _tflite_predict(export_tflite(model, quantize=quantize))
+
+    raise ValueError(f"Unknown backend '{backend}', expected 'keras', 'graph' or 'tflite'")
+
+def _rebatch(batches, batch_size):
+    # Row groups are smaller than a good inference batch, so they are joined
+    # into batches of exactly batch_size events (the last one may be smaller),
+    # which also keeps the compiled graph from being retraced for new shapes
+    buffer = []
+    buffered = 0
+    for df in batches:
+        buffer.append(df)
+        buffered += len(df)
+        if buffered >= batch_size:
+            joined = pd.concat(buffer, ignore_index=True)
+            n_full = (len(joined) // batch_size) * batch_size
+            for start in range(0, n_full, batch_size):
+                yield joined.iloc[start:start + batch_size]
+            buffer = [joined.iloc[n_full:]]
+            buffered = len(joined) - n_full
+    if buffered > 0:
+        yield pd.concat(buffer, ignore_index=True)
+
+def score_dataset(dataset_path, predict, features, mean, scale, out_path, batch_size=65536, histogram=None):
+    # Streams a processed dataset through predict in batches of
+    # batch_size events and writes one score per event to a Parquet file,
+    # together with the label and sample columns when the dataset has them.
+    # A ScoreHistogram passed as histogram is filled with the labelled scores.
+    # Returns (events scored, seconds spent in predict).
+    names = open_dataset(dataset_path).schema.names
+    extra = [c for c in (LABEL_COLUMN, SAMPLE_COLUMN) if c in names]
+
+    mean = mean.astype(np.float32)
+    scale = scale.astype(np.float32)
+
+    writer = None
+    n_events = 0
+    predict_time = 0.0
+
+    for df in _rebatch(iter_batches(dataset_path, columns=features + extra), batch_size):
+        X = (df[features].to_numpy(dtype=np.float32) - mean) / scale
+
+        start = time.perf_counter()
+        scores = predict(X)
+        predict_time += time.perf_counter() - start
+
+        columns = {"score": pa.array(scores.astype(np.float32))}
+        for c in extra:
+            columns[c] = pa.array(df[c].to_numpy())
+        table = pa.table(columns)
+
+        if histogram is not None and LABEL_COLUMN in extra:
+            histogram.fill(scores, df[LABEL_COLUMN].to_numpy())
+
+        if writer is None:
+            writer = pq.ParquetWriter(out_path, table.schema, compression="zstd")
+        writer.write_table(table)
+        n_events += len(X)
+
+    if writer is not None:
+        writer.close()
+
+    return n_events, predict_time
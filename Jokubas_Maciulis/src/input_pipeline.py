@@ -0,0 +1,54 @@
+import numpy as np
+import pyarrow.parquet as pq
+import tensorflow as tf
+
+from src.dataset import LABEL_COLUMN
+from src.stats import FeatureStats
+
+def _read_unit(path, row_group, columns):
+    table = pq.ParquetFile(path).read_row_group(row_group, columns=columns)
+    return np.column_stack([table.column(c).to_numpy() for c in columns])
+
+def feature_moments(units, features):
+    # Mean and standard deviation per feature in one streaming pass over the
+    # row groups, with a zero std replaced by 1 like StandardScaler does
+    stats = FeatureStats(len(features))
+    for path, row_group, _ in units:
+        stats.update(_read_unit(path, row_group, features))
+
+    return stats.mean, stats.scale
+
+def make_tf_dataset(units, features, mean, std, batch_size=128, shuffle_buffer=None, seed=42):
+    # Row groups are read in parallel, standardized as a whole, split into
+    # single events, shuffled through a bounded buffer, batched and prefetched.
+    # Without shuffle_buffer the events come out in the order of units.
+    # Features travel as float32 and labels as uint8, like they are stored.
+    n_features = len(features)
+    mean = tf.constant(mean, dtype=tf.float32)
+    std = tf.constant(std, dtype=tf.float32)
+
+    def read(path, row_group):
+        table = pq.ParquetFile(path.decode()).read_row_group(int(row_group), columns=features + [LABEL_COLUMN])
+        X = np.column_stack([table.column(c).to_numpy() for c in features]).astype(np.float32, copy=False)
+        return X, table.column(LABEL_COLUMN).to_numpy()
+
+    def load(path, row_group):
+        X, y = tf.numpy_function(read, [path, row_group], (tf.float32, tf.uint8))
+        X.set_shape([None, n_features])
+        y.set_shape([None])
+        return (X - mean) / std, y
+
+    paths = [unit[0] for unit in units]
+    row_groups = [unit[1] for unit in units]
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, row_groups))
+    if shuffle_buffer:
+        ds = ds.shuffle(len(units), seed=seed, reshuffle_each_iteration=True)
+
+    ds = ds.map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle_buffer)
+    ds = ds.unbatch()
+
+    if shuffle_buffer:
+        ds = ds.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
@@ -0,0 +1,140 @@
+import json
+import os
+import platform
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+
+def _io_counters():
+    # Bytes passed through read()/write() calls of this process (files and
+    # sockets, so XRootD traffic is included). Linux only, zeros elsewhere.
+    counters = {"rchar": 0, "wchar": 0}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters["rchar"], counters["wchar"]
+
+def _cpu_seconds():
+    # This process (all threads) plus finished worker processes
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+class RunReport:
+    # Wall time, CPU time, peak RSS and bytes read/written per named stage.
+    # A stage entered several times (e.g. "read" once per chunk) is summed.
+    # CPU time, bytes and RSS are measured for the whole process, so a report
+    # of a background thread (wall_only=True) records only wall time: the CPU
+    # and I/O of that thread are counted in the stages of the main thread
+    # that run at the same time. Its stages are marked "background".
+    def __init__(self, name, wall_only=False):
+        self.name = name
+        self.wall_only = wall_only
+        self.started = time.time()
+        self.stages = {}
+
+    def _entry(self, name):
+        return self.stages.setdefault(name, {
+            "calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "bytes_read": 0, "bytes_written": 0, "peak_rss_mb": 0.0,
+        })
+
+    @contextmanager
+    def stage(self, name):
+        if self.wall_only:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                entry = self._entry(name)
+                entry["calls"] += 1
+                entry["wall_s"] += time.perf_counter() - start
+                entry["background"] = True
+            return
+
+        read_before, written_before = _io_counters()
+        cpu_before = _cpu_seconds()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            read_after, written_after = _io_counters()
+
+            entry = self._entry(name)
+            entry["calls"] += 1
+            entry["wall_s"] += wall
+            entry["cpu_s"] += _cpu_seconds() - cpu_before
+            entry["bytes_read"] += read_after - read_before
+            entry["bytes_written"] += written_after - written_before
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], peak_rss_mb())
+
+    def add_stages(self, stages):
+        # Sums the stages recorded by another report (e.g. in a background
+        # thread) into this one
+        for name, other in stages.items():
+            entry = self._entry(name)
+            for key, value in other.items():
+                if key == "peak_rss_mb":
+                    entry[key] = max(entry[key], value)
+                elif key in ("calls", "wall_s", "cpu_s", "bytes_read", "bytes_written"):
+                    entry[key] += value
+                else:
+                    entry[key] = value
+
+    def add(self, name, **values):
+        # Extra numbers for a stage, e.g. events=... or samples_per_s=...
+        entry = self._entry(name)
+        for key, value in values.items():
+            entry[key] = value
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "total_wall_s": time.time() - self.started,
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": self.stages,
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self):
+        lines = [f"{'stage':<24}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'read MB':>10}{'written MB':>12}{'peak RSS MB':>13}"]
+        for name, entry in self.stages.items():
+            lines.append(f"{name:<24}{entry['calls']:>7}{entry['wall_s']:>10.2f}{entry['cpu_s']:>10.2f}"
+                         f"{entry['bytes_read'] / 1e6:>10.1f}{entry['bytes_written'] / 1e6:>12.1f}"
+                         f"{entry['peak_rss_mb']:>13.0f}")
+        return "\n".join(lines)
+
+def stage(report, name):
+    # report.stage(name), or nothing when no report is collected
+    return nullcontext() if report is None else report.stage(name)
+
+def epoch_throughput_callback(report, samples_per_epoch):
+    # Keras callback recording every epoch as stage "epoch_<n>" with samples/s
+    import tensorflow as tf
+
+    class EpochThroughput(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self._stage = report.stage(f"epoch_{epoch + 1}")
+            self._stage.__enter__()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self._stage.__exit__(None, None, None)
+            name = f"epoch_{epoch + 1}"
+            wall = report.stages[name]["wall_s"]
+            report.add(name, samples=samples_per_epoch, samples_per_s=samples_per_epoch / wall if wall > 0 else 0.0)
+
+    return EpochThroughput()
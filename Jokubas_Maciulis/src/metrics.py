@@ -0,0 +1,101 @@
+import numpy as np
+
+class ScoreHistogram:
+    # Fine-binned signal and background score histograms. They are filled
+    # chunk by chunk, histograms of different workers are merged by adding
+    # them, and ROC, AUC and working points are derived from the counts alone.
+    # Scores inside one bin count as ties, so the ROC is exact at the bin edges.
+    def __init__(self, n_bins=10000, low=0.0, high=1.0):
+        self.n_bins = n_bins
+        self.low = low
+        self.high = high
+        self.signal = np.zeros(n_bins, dtype=np.int64)
+        self.background = np.zeros(n_bins, dtype=np.int64)
+
+    @property
+    def edges(self):
+        return np.linspace(self.low, self.high, self.n_bins + 1)
+
+    def fill(self, scores, labels):
+        scores = np.asarray(scores, dtype=np.float64)
+        labels = np.asarray(labels)
+
+        bins = ((scores - self.low) / (self.high - self.low) * self.n_bins).astype(np.int64)
+        bins = np.clip(bins, 0, self.n_bins - 1)
+
+        self.signal += np.bincount(bins[labels == 1], minlength=self.n_bins)
+        self.background += np.bincount(bins[labels != 1], minlength=self.n_bins)
+        return self
+
+    def merge(self, other):
+        if (self.n_bins, self.low, self.high) != (other.n_bins, other.low, other.high):
+            raise ValueError("Cannot merge histograms with different binning")
+        merged = ScoreHistogram(self.n_bins, self.low, self.high)
+        merged.signal = self.signal + other.signal
+        merged.background = self.background + other.background
+        return merged
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    def roc(self):
+        # Cutting at every lower bin edge from the highest score down.
+        # Returns fpr, tpr and thresholds like sklearn.metrics.roc_curve.
+        tpr = np.concatenate([[0], np.cumsum(self.signal[::-1])]) / max(self.signal.sum(), 1)
+        fpr = np.concatenate([[0], np.cumsum(self.background[::-1])]) / max(self.background.sum(), 1)
+        thresholds = np.concatenate([[np.inf], self.edges[-2::-1]])
+        return fpr, tpr, thresholds
+
+    def auc(self):
+        fpr, tpr, _ = self.roc()
+        # Trapezoids, i.e. events in the same bin are counted as ties
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def signal_efficiency(self, background_efficiency):
+        # Signal efficiency at a given background efficiency (mistag rate)
+        fpr, tpr, _ = self.roc()
+        return float(np.interp(background_efficiency, fpr, tpr))
+
+    def working_point(self, signal_efficiency):
+        # Highest threshold keeping at least signal_efficiency of the signal,
+        # returns (threshold, signal efficiency, background efficiency)
+        fpr, tpr, thresholds = self.roc()
+        i = min(np.searchsorted(tpr, signal_efficiency), len(tpr) - 1)
+        return float(thresholds[i]), float(tpr[i]), float(fpr[i])
+
+    def save(self, path):
+        np.savez(path, signal=self.signal, background=self.background,
+                 binning=np.array([self.n_bins, self.low, self.high]))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        n_bins, low, high = data["binning"]
+        hist = cls(int(n_bins), float(low), float(high))
+        hist.signal = data["signal"]
+        hist.background = data["background"]
+        return hist
+
+def _tpr_at(fpr, tpr, grid):
+    # Best signal efficiency with a background efficiency of at most grid,
+    # well defined also where the ROC has vertical steps
+    i = np.searchsorted(fpr, grid, side="right") - 1
+    return np.maximum.accumulate(tpr)[i]
+
+def roc_approximation_error(hist, labels, scores, n_points=1001):
+    # Compares the histogram ROC with the exact sklearn result on the same events
+    from sklearn.metrics import roc_curve, auc
+
+    fpr, tpr, _ = roc_curve(labels, scores)
+    exact_auc = auc(fpr, tpr)
+
+    hist_fpr, hist_tpr, _ = hist.roc()
+    grid = np.linspace(0, 1, n_points)
+    tpr_error = np.abs(_tpr_at(hist_fpr, hist_tpr, grid) - _tpr_at(fpr, tpr, grid)).max()
+
+    return {
+        "exact_auc": float(exact_auc),
+        "histogram_auc": hist.auc(),
+        "auc_error": abs(hist.auc() - float(exact_auc)),
+        "max_tpr_error": float(tpr_error),
+    }
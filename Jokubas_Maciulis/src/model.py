@@ -0,0 +1,20 @@
+import tensorflow as tf
+
+def build_model(n_features, hidden=(64, 32, 16), learning_rate=0.001):
+    # Dense layers with LeakyReLU activations and one sigmoid output,
+    # compiled for binary classification
+    layers = [tf.keras.layers.Input(shape=(n_features,))]
+    for units in hidden:
+        layers.append(tf.keras.layers.Dense(units))
+        layers.append(tf.keras.layers.LeakyReLU())
+    layers.append(tf.keras.layers.Dense(1, activation="sigmoid"))
+
+    model = tf.keras.Sequential(layers)
+
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+        loss="binary_crossentropy",
+        metrics=["accuracy", tf.keras.metrics.AUC(name="auc")]
+    )
+
+    return model
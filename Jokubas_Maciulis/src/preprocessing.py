@@ -1,75 +1,876 @@
+import contextlib
+import glob
+import hashlib
+import json
+import operator
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import repeat
+from typing import Optional
+
 import pandas as pd
 import numpy as np
 import awkward as ak
+import fsspec
 import uproot
 
-def flatten_electrons(arr, max_electrons=2):
-    df = pd.DataFrame()
+from src.instrumentation import RunReport, stage
+
+@dataclass
+class CollectionSpec:
+    # One NanoAOD collection flattened to a fixed number of objects per event.
+    # fields maps branch suffixes ("btagDeepFlavB") to output names ("btag"),
+    # the output columns are n<name>, <name>1_<out>, ..., <name><max_objects>_<out>.
+    # Values are stored as dtype and the object count as count_dtype, float32
+    # and uint8 keep the processed dataset at a quarter of float64 CSV columns.
+    name: str
+    fields: dict
+    max_objects: int
+    fill_value: float = 0
+    dtype: type = np.float32
+    count_dtype: type = np.uint8
+
+# Class label column written next to the features, 1 = signal, 0 = background
+TARGET_DTYPE = np.uint8
+
+def electron_spec(max_electrons=2):
+    return CollectionSpec("Electron", {"pt": "pt", "eta": "eta"}, max_electrons)
+
+def jet_spec(max_jets=4):
+    return CollectionSpec("Jet", {"pt": "pt", "eta": "eta", "phi": "phi", "btagDeepFlavB": "btag"}, max_jets)
+
+@dataclass
+class EventFeatures:
+    # Event-level features computed on the jagged Electron and Jet collections
+    # before padding, vectorized over the whole chunk:
+    #   mee        invariant mass of the two leading electrons (massless)
+    #   dR_ee      Delta R between the two leading electrons
+    #   dRmin_ej   smallest Delta R between the leading electron and any jet
+    #   HT         scalar sum of the jet pT
+    # Jets closer than overlap_dr to any electron are removed first, from
+    # these features and from the Jet columns (None keeps every jet).
+    # Events without the needed objects get fill_value.
+    overlap_dr: Optional[float] = 0.4
+    fill_value: float = 0
+    dtype: type = np.float32
+
+    columns = ("mee", "dR_ee", "dRmin_ej", "HT")
+    branches = ("Electron_pt", "Electron_eta", "Electron_phi", "Jet_pt", "Jet_eta", "Jet_phi")
+
+def default_specs(max_electrons=2, max_jets=4, event_features=True):
+    specs = [electron_spec(max_electrons), jet_spec(max_jets)]
+    if event_features:
+        specs.append(EventFeatures())
+    return specs
+
+@dataclass
+class Cut:
+    # Event preselection applied to the jagged arrays before flattening.
+    # variable is "n<Collection>" for the object count (e.g. "nElectron") or a
+    # branch name (e.g. "Electron_pt"); index picks one object of a jagged
+    # branch (0 = leading) and events without that object fail the cut.
+    variable: str
+    op: str
+    value: float
+    index: Optional[int] = None
+
+    @property
+    def name(self):
+        variable = self.variable if self.index is None else f"{self.variable}[{self.index}]"
+        return f"{variable} {self.op} {self.value}"
+
+    def branch_for(self, branches):
+        # The count of "n<Collection>" is taken from a branch of that
+        # collection if one is among branches, else the counter branch itself
+        # is read
+        if self.variable.startswith("n") and "_" not in self.variable:
+            prefix = f"{self.variable[1:]}_"
+            for branch in branches:
+                if branch.startswith(prefix):
+                    return branch
+        return self.variable
+
+_CUT_OPS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+def branches_for_specs(specs, cuts=None):
+    # Only the branches that produce output columns or are needed by a cut are read
+    branches = [f"{spec.name}_{field}" for spec in specs if isinstance(spec, CollectionSpec) for field in spec.fields]
+    extra = [branch for spec in specs if isinstance(spec, EventFeatures) for branch in spec.branches]
+    for branch in extra:
+        if branch not in branches:
+            branches.append(branch)
+    for cut in cuts or []:
+        branch = cut.branch_for(branches)
+        if branch not in branches:
+            branches.append(branch)
+    return branches
+
+def _cut_mask(arr, cut):
+    branch = cut.branch_for(arr.fields)
+    values = arr[branch]
+    if branch != cut.variable:
+        values = ak.num(values)
+    elif cut.index is not None:
+        values = ak.pad_none(values, cut.index + 1, clip=True)[:, cut.index]
+
+    if values.ndim > 1:
+        raise ValueError(f"Cut {cut.name!r} is on the jagged branch {branch!r}, "
+                         f"set index to pick one object per event (e.g. index=0 for the leading one)")
+
+    mask = _CUT_OPS[cut.op](values, cut.value)
+    return ak.to_numpy(ak.fill_none(mask, False))
+
+def apply_cuts(arr, cuts, cutflow=None):
+    # Cuts are applied in order; cutflow (a dict) accumulates the number of
+    # events before any cut ("all") and after each cut
+    if cutflow is not None:
+        cutflow["all"] = cutflow.get("all", 0) + len(arr)
+
+    for cut in cuts or []:
+        arr = arr[_cut_mask(arr, cut)]
+        if cutflow is not None:
+            cutflow[cut.name] = cutflow.get(cut.name, 0) + len(arr)
 
-    df["nElectron"] = ak.num(arr["Electron_pt"])
+    return arr
 
-    padded_pt  = ak.pad_none(arr["Electron_pt"],  max_electrons)
-    padded_eta = ak.pad_none(arr["Electron_eta"], max_electrons)
+def preselection_cuts(min_electrons=0, min_lead_pt=None):
+    # The electron preselection of the command line scripts: at least
+    # min_electrons electrons and a leading electron above min_lead_pt GeV
+    cuts = []
+    if min_electrons > 0:
+        cuts.append(Cut("nElectron", ">=", min_electrons))
+    if min_lead_pt is not None:
+        cuts.append(Cut("Electron_pt", ">", min_lead_pt, index=0))
+    return cuts
 
-    for i in range(max_electrons):
-        df[f"Electron{i+1}_pt"]  = ak.to_numpy(ak.fill_none(padded_pt[:,  i],  0))
-        df[f"Electron{i+1}_eta"] = ak.to_numpy(ak.fill_none(padded_eta[:, i], 0))
+def parse_step_size(value):
+    # Chunk size from the command line: a number of entries ("100000") or a
+    # size string for uproot ("100 MB")
+    return int(value) if value.isdigit() else value
+
+def cutflow_table(cutflows):
+    # cutflows: {sample: cutflow dict} -> one row per sample
+    return pd.DataFrame.from_dict(cutflows, orient="index").fillna(0).astype(int)
+
+def _delta_r(a, b):
+    dphi = (a.phi - b.phi + np.pi) % (2 * np.pi) - np.pi
+    return np.sqrt((a.eta - b.eta) ** 2 + dphi ** 2)
+
+def event_features(arr, spec):
+    # Returns arr with the overlapping jets removed and {column: values}
+    electrons = ak.zip({"pt": arr["Electron_pt"], "eta": arr["Electron_eta"], "phi": arr["Electron_phi"]})
+    jets = ak.zip({"pt": arr["Jet_pt"], "eta": arr["Jet_eta"], "phi": arr["Jet_phi"]})
+
+    if spec.overlap_dr is not None:
+        # (jet, electron) pairs per jet, a jet is kept if no electron is close
+        pairs = ak.cartesian({"jet": jets, "electron": electrons}, nested=True)
+        keep = ak.all(_delta_r(pairs.jet, pairs.electron) >= spec.overlap_dr, axis=-1)
+        # All Jet columns are masked together in one record array
+        jet_fields = [name for name in arr.fields if name.startswith("Jet_")]
+        cleaned = ak.zip({name: arr[name] for name in jet_fields})[keep]
+        for name in jet_fields:
+            arr = ak.with_field(arr, cleaned[name], name)
+        jets = ak.zip({"pt": cleaned["Jet_pt"], "eta": cleaned["Jet_eta"], "phi": cleaned["Jet_phi"]})
+
+    # At most one pair per event: the two leading electrons
+    leading = ak.firsts(ak.combinations(electrons[:, :2], 2))
+    mee = np.sqrt(2 * leading["0"].pt * leading["1"].pt *
+                  (np.cosh(leading["0"].eta - leading["1"].eta) - np.cos(leading["0"].phi - leading["1"].phi)))
+
+    # The leading electron (None without electrons) broadcasts against the jets
+    dr_ej = ak.min(_delta_r(ak.firsts(electrons), jets), axis=1)
+
+    columns = {
+        "mee": mee,
+        "dR_ee": _delta_r(leading["0"], leading["1"]),
+        "dRmin_ej": dr_ej,
+        "HT": ak.sum(jets.pt, axis=1),
+    }
+    return arr, {name: ak.to_numpy(ak.fill_none(values, spec.fill_value)).astype(spec.dtype)
+                 for name, values in columns.items()}
+
+def flatten_collections(arr, specs):
+    # Event features come first, their overlap removal changes the jets
+    derived = {}
+    for spec in specs:
+        if isinstance(spec, EventFeatures):
+            arr, columns = event_features(arr, spec)
+            derived.update(columns)
+    specs = [spec for spec in specs if isinstance(spec, CollectionSpec)]
+
+    n_events = len(arr)
+    n_values = sum(len(spec.fields) * spec.max_objects for spec in specs)
+    dtype = np.result_type(*[spec.dtype for spec in specs]) if specs else np.float32
+
+    # All padded values go into one (events x values) matrix, every field is
+    # padded once and written to its slot-major columns with a strided slice
+    values = np.empty((n_events, n_values), dtype=dtype)
+    value_names = []
+    counts = []
+
+    offset = 0
+    for spec in specs:
+        width = len(spec.fields)
+        stop = offset + width * spec.max_objects
+
+        for j, field in enumerate(spec.fields):
+            jagged = arr[f"{spec.name}_{field}"]
+            if j == 0:
+                count = ak.to_numpy(ak.num(jagged))
+                if len(count) and count.max() > np.iinfo(spec.count_dtype).max:
+                    raise ValueError(f"n{spec.name} = {count.max()} does not fit in {np.dtype(spec.count_dtype)}")
+                counts.append((len(value_names), f"n{spec.name}", count.astype(spec.count_dtype)))
+
+            padded = ak.fill_none(ak.pad_none(jagged, spec.max_objects, clip=True), spec.fill_value)
+            values[:, offset + j:stop:width] = ak.to_numpy(padded)
+
+        value_names += [f"{spec.name}{i+1}_{out}" for i in range(spec.max_objects) for out in spec.fields.values()]
+        offset = stop
+
+    df = pd.DataFrame(values, columns=value_names, copy=False)
+
+    # Count columns go in front of their collection
+    for shift, (position, name, count) in enumerate(counts):
+        df.insert(position + shift, name, count)
+
+    for name, values in derived.items():
+        df[name] = values
 
     return df
 
+def flatten_electrons(arr, max_electrons=2):
+    return flatten_collections(arr, [electron_spec(max_electrons)])
+
 def flatten_jets(arr, max_jets=4):
-    df = pd.DataFrame()
-    df["nJet"] = ak.num(arr["Jet_pt"])
-    
-    padded_pt  = ak.pad_none(arr["Jet_pt"], max_jets)
-    padded_eta = ak.pad_none(arr["Jet_eta"], max_jets)
-    padded_phi = ak.pad_none(arr["Jet_phi"], max_jets)
-    padded_btag = ak.pad_none(arr["Jet_btagDeepFlavB"], max_jets)
-    
-    for i in range(max_jets):
-        df[f"Jet{i+1}_pt"] = ak.to_numpy(ak.fill_none(padded_pt[:, i], 0))
-        df[f"Jet{i+1}_eta"] = ak.to_numpy(ak.fill_none(padded_eta[:, i], 0))
-        df[f"Jet{i+1}_phi"] = ak.to_numpy(ak.fill_none(padded_phi[:, i], 0))
-        df[f"Jet{i+1}_btag"] = ak.to_numpy(ak.fill_none(padded_btag[:, i], 0))
-    
-    return df
+    return flatten_collections(arr, [jet_spec(max_jets)])
 
-def load_dataset_from_txt(txt_file, target_label, max_events = None, branches = None, max_electrons=2, max_jets=4):
-    
+def _branch_bytes(tree, branches, entry_stop=None, entry_start=0):
+    # Compressed and uncompressed size of every basket overlapping [entry_start, entry_stop),
+    # which is what uproot fetches and decompresses for the read
+    if entry_stop is None or entry_stop > tree.num_entries:
+        entry_stop = tree.num_entries
+
+    sizes = {}
+    for name in branches:
+        branch = tree[name]
+        compressed = 0
+        uncompressed = 0
+        for i in range(branch.num_baskets):
+            start, stop = branch.basket_entry_start_stop(i)
+            if start < entry_stop and stop > entry_start:
+                compressed += branch.basket_compressed_bytes(i)
+                uncompressed += branch.basket_uncompressed_bytes(i)
+        sizes[name] = (compressed, uncompressed)
+
+    return sizes
+
+def _add_io(io_report, sizes):
+    if io_report is None:
+        return
+    for name, (compressed, uncompressed) in sizes.items():
+        total = io_report.setdefault(name, [0, 0])
+        total[0] += compressed
+        total[1] += uncompressed
+
+def io_report_table(io_report):
+    df = pd.DataFrame(
+        [(name, compressed, uncompressed) for name, (compressed, uncompressed) in io_report.items()],
+        columns=["branch", "compressed_bytes", "uncompressed_bytes"]
+    )
+    df["fraction"] = df["compressed_bytes"] / max(df["compressed_bytes"].sum(), 1)
+    return df.sort_values("compressed_bytes", ascending=False).reset_index(drop=True)
+
+class RootFileCache:
+    # On-disk copies of remote ROOT files (e.g. root://eospublic.cern.ch//eos/...).
+    # A copy is named <sha256(path)>-<size>.root, so a remote file that changes
+    # size is fetched again. Every hit refreshes the file mtime and, when the
+    # cache grows past max_bytes, the least recently used copies are removed.
+    # In offline mode only existing copies are used and nothing is fetched.
+    def __init__(self, cache_dir, max_bytes=None, offline=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.offline = offline
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, file_path):
+        return hashlib.sha256(file_path.encode()).hexdigest()[:32]
+
+    def _copies(self, key="*"):
+        return glob.glob(os.path.join(self.cache_dir, f"{key}-*.root"))
+
+    def local_path(self, file_path, evict=True):
+        # evict=False leaves the cache over max_bytes until evict() is called,
+        # for callers that fetch several files before reading any of them
+        key = self._key(file_path)
+
+        if self.offline:
+            copies = self._copies(key)
+            if not copies:
+                raise FileNotFoundError(f"{file_path} is not in the cache {self.cache_dir} (offline mode)")
+            local = max(copies, key=os.path.getmtime)
+            os.utime(local)
+            return local
+
+        fs, remote = fsspec.core.url_to_fs(file_path)
+        size = fs.size(remote)
+        local = os.path.join(self.cache_dir, f"{key}-{size}.root")
+
+        if os.path.exists(local):
+            os.utime(local)
+            return local
+
+        for stale in self._copies(key):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(stale)
+
+        # Download to a unique file next to the final name and rename, so
+        # readers never see a partial file and concurrent fetches of the same
+        # file do not share a temporary file. If another fetch finished
+        # first, its copy is used.
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{key}-", suffix=".tmp")
+        os.close(fd)
+        try:
+            fs.get_file(remote, tmp)
+            if os.path.exists(local):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, local)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+
+        if evict:
+            self.evict(keep=[local])
+        return local
+
+    def evict(self, keep=()):
+        # Removes the least recently used copies, except keep, until the cache
+        # fits in max_bytes. Other threads or processes may remove copies at
+        # the same time.
+        if self.max_bytes is None:
+            return
+
+        copies = []
+        for copy in self._copies():
+            with contextlib.suppress(FileNotFoundError):
+                copies.append((os.path.getmtime(copy), os.path.getsize(copy), copy))
+        copies.sort()
+
+        total = sum(size for _, size, _ in copies)
+        for _, size, copy in copies:
+            if total <= self.max_bytes:
+                break
+            if copy in keep:
+                continue
+            total -= size
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(copy)
+
+def _open_events(file_path, cache=None):
+    if cache is not None:
+        file_path = cache.local_path(file_path)
+    root_file = uproot.open(file_path)
+    return root_file, root_file["Events"]
+
+def _read_file(file_path, branches, entry_stop, with_io=False, cache=None, report=None, entry_start=None):
+    with stage(report, "open"):
+        root_file, tree = _open_events(file_path, cache)
+
+    with root_file:
+        sizes = _branch_bytes(tree, branches, entry_stop, entry_start or 0) if with_io else {}
+        with stage(report, "read"):
+            arr = tree.arrays(branches, library="ak", entry_start=entry_start, entry_stop=entry_stop)
+
+    return arr, sizes
+
+def _read_range(entry_range, branches, with_io=False, cache=None, report=None):
+    file_path, entry_start, entry_stop = entry_range
+    return _read_file(file_path, branches, entry_stop, with_io, cache, report, entry_start=entry_start)
+
+def _file_stamp(file_path):
+    # Size and modification time as reported by fsspec, None when the file
+    # system cannot be queried (then cached metadata is trusted as is)
+    try:
+        fs, path = fsspec.core.url_to_fs(file_path)
+        info = fs.info(path)
+    except (ImportError, ValueError, OSError):
+        return None
+    return [info.get("size"), str(info.get("mtime"))]
+
+def _probe_file(file_path, cache=None):
+    # Only the file header and the TTree metadata are fetched. A RootFileCache
+    # is used offline only, so probing never downloads whole files.
+    root_file, tree = _open_events(file_path, cache if cache is not None and cache.offline else None)
+    with root_file:
+        return {
+            "num_entries": int(tree.num_entries),
+            "offsets": [int(o) for o in tree.common_entry_offsets()],
+        }
+
+def _probe_cached(file_path, known, cache=None):
+    stamp = _file_stamp(file_path)
+    entry = known.get(file_path)
+    if entry is not None and (stamp is None or entry["stamp"] == stamp):
+        return entry
+    return dict(_probe_file(file_path, cache), stamp=stamp)
+
+def probe_files(files, n_workers=16, cache=None, metadata_path=None):
+    # {file: {"num_entries", "offsets", "stamp"}} for all files, probed
+    # concurrently by a thread pool. offsets are the cluster boundaries
+    # (entries where every branch starts a basket). With metadata_path the
+    # answers are kept in a JSON file and reused while the file stamp matches.
+    known = {}
+    if metadata_path is not None and os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            known = json.load(f)
+
+    files = list(dict.fromkeys(str(f) for f in files))
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+        metadata = dict(zip(files, pool.map(_probe_cached, files, repeat(known), repeat(cache))))
+
+    if metadata_path is not None:
+        known.update(metadata)
+        os.makedirs(os.path.dirname(metadata_path) or ".", exist_ok=True)
+        tmp = f"{metadata_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(known, f)
+        os.replace(tmp, metadata_path)
+
+    return metadata
+
+def _split_entries(offsets, entry_stop, split_entries):
+    # Boundaries of about split_entries entries each in [0, entry_stop), put on
+    # cluster offsets so no range decompresses baskets of its neighbours.
+    # Files written as a single cluster are split evenly instead.
+    offsets = [o for o in offsets if 0 < o < entry_stop]
+    if not offsets:
+        n_ranges = max(1, round(entry_stop / split_entries))
+        offsets = [entry_stop * i // n_ranges for i in range(1, n_ranges)]
+
+    bounds = [0]
+    for offset in offsets:
+        if offset - bounds[-1] >= split_entries:
+            bounds.append(offset)
+    if entry_stop - bounds[-1] < split_entries / 2 and len(bounds) > 1:
+        bounds.pop()
+    bounds.append(entry_stop)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def plan_entry_ranges(files, metadata, max_events=None, split_entries=None):
+    # (file, entry_start, entry_stop) tasks that cover the files in order and
+    # add up to exactly max_events entries. Files past the quota get no task
+    # and are never opened. With split_entries, files are further cut into
+    # cluster-aligned ranges of about that many entries.
+    ranges = []
+    planned = 0
+
+    for file_path in files:
+        if max_events is not None and planned >= max_events:
+            break
+
+        info = metadata[str(file_path)]
+        entry_stop = info["num_entries"]
+        if max_events is not None:
+            entry_stop = min(entry_stop, max_events - planned)
+        if entry_stop == 0:
+            continue
+
+        if split_entries is None:
+            ranges.append((str(file_path), 0, entry_stop))
+        else:
+            for start, stop in _split_entries(info["offsets"], entry_stop, split_entries):
+                ranges.append((str(file_path), start, stop))
+
+        planned += entry_stop
+
+    return ranges
+
+def _make_executor(n_workers, executor):
+    if executor == "process":
+        return ProcessPoolExecutor(max_workers=n_workers)
+    if executor == "thread":
+        return ThreadPoolExecutor(max_workers=n_workers)
+    raise ValueError(f"Unknown executor '{executor}', expected 'process' or 'thread'")
+
+def prefetched(iterable, depth=1, timings=None, report=None):
+    # Iterates over iterable in a background thread that runs at most depth
+    # items ahead of the consumer, so the next file or chunk is fetched and
+    # decompressed while the current one is processed. Memory is bounded by
+    # depth + 2 items. Exceptions of the producer are raised in the consumer.
+    # timings is the RunReport the producer records its stages (open, read)
+    # to; they are handed over with every item and added to report by the
+    # consumer, so the background thread never writes to report itself.
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                stages = None
+                if timings is not None:
+                    stages, timings.stages = timings.stages, {}
+                if not put((item, stages, None)):
+                    break
+            else:
+                put((done, timings.stages if timings is not None else None, None))
+        except BaseException as error:
+            put((done, None, error))
+        finally:
+            # A generator has to be closed by the thread that runs it
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, stages, error = items.get()
+            if error is not None:
+                raise error
+            if stages and report is not None:
+                report.add_stages(stages)
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def _read_sequential(files, branches, max_events=None, with_io=False, cache=None, report=None):
+    # Whole files one after the other until max_events entries are read
+    loaded = 0
+    for file_path in files:
+        if max_events is not None and loaded >= max_events:
+            break
+
+        events_left = None
+        if max_events is not None:
+            events_left = max_events - loaded
+
+        arr, sizes = _read_file(file_path, branches, events_left, with_io, cache, report)
+        loaded += len(arr)
+        yield arr, sizes
+
+def _read_files(files, branches, max_events=None, n_workers=None, executor="process", io_report=None,
+                cuts=None, cutflow=None, cache=None, report=None, split_entries=None, metadata=None, prefetch=0):
     arrays = []
     loaded = 0
+    with_io = io_report is not None
+
+    if metadata is None and split_entries is not None:
+        with stage(report, "plan"):
+            metadata = probe_files(files, n_workers or 1, cache)
+
+    if n_workers is None or n_workers <= 1:
+        # With prefetch, the reads run in a background thread up to prefetch
+        # files ahead. Its open and read stages are handed over with every
+        # file, "prefetch_wait" is the time spent waiting for it.
+        read_report = RunReport("prefetch", wall_only=True) if prefetch and report is not None else report
+        if metadata is not None:
+            ranges = plan_entry_ranges(files, metadata, max_events)
+            reads = (_read_range(entry_range, branches, with_io, cache, read_report) for entry_range in ranges)
+        else:
+            reads = _read_sequential(files, branches, max_events, with_io, cache, read_report)
+        if prefetch:
+            reads = prefetched(reads, prefetch, read_report, report)
+
+        while True:
+            with stage(report if prefetch else None, "prefetch_wait"):
+                result = next(reads, None)
+            if result is None:
+                break
+
+            arr, sizes = result
+            _add_io(io_report, sizes)
+            with stage(report, "select"):
+                arrays.append(apply_cuts(arr, cuts, cutflow))
+
+        return arrays
+
+    if metadata is not None:
+        # The exact ranges to read are known up front: files past the quota
+        # are skipped and every range is one task, so one large file no longer
+        # keeps a single worker busy at the end. pool.map returns the ranges
+        # in order, so the rows match the sequential loop.
+        ranges = plan_entry_ranges(files, metadata, max_events, split_entries)
+
+        # Ranges of one file go to several workers, so every file is fetched
+        # into the cache once, concurrently, before the workers read local paths.
+        # The copies of this plan are only evicted once they are all read.
+        if cache is not None:
+            with stage(report, "fetch"), ThreadPoolExecutor(max_workers=n_workers) as fetch_pool:
+                remote = list(dict.fromkeys(file_path for file_path, _, _ in ranges))
+                local = dict(zip(remote, fetch_pool.map(cache.local_path, remote, repeat(False))))
+            ranges = [(local[file_path], start, stop) for file_path, start, stop in ranges]
+
+        with stage(report, "read"), _make_executor(n_workers, executor) as pool:
+            results = pool.map(_read_range, ranges, repeat(branches), repeat(with_io))
+            for arr, sizes in results:
+                _add_io(io_report, sizes)
+                arrays.append(apply_cuts(arr, cuts, cutflow))
+
+        if cache is not None:
+            cache.evict()
+
+        return arrays
+
+    # Files are read in windows of n_workers. Every file in a window may read
+    # up to the remaining quota, the surplus is cut off below so that exactly
+    # max_events are kept, in the same order as the sequential loop.
+    # Workers open and read, so both are recorded together as "read".
+    with stage(report, "read"), _make_executor(n_workers, executor) as pool:
+        for start in range(0, len(files), n_workers):
+            if max_events is not None and loaded >= max_events:
+                break
+
+            events_left = None
+            if max_events is not None:
+                events_left = max_events - loaded
+
+            window = files[start:start + n_workers]
+            results = pool.map(_read_file, window, repeat(branches), repeat(events_left),
+                               repeat(with_io), repeat(cache))
+            for arr, sizes in results:
+                _add_io(io_report, sizes)
+                if max_events is not None:
+                    arr = arr[:max_events - loaded]
+                if len(arr) == 0:
+                    continue
+                loaded += len(arr)
+                arrays.append(apply_cuts(arr, cuts, cutflow))
+
+    return arrays
+
+def _flatten_block(arr, target_label, specs, report=None):
+    with stage(report, "flatten"):
+        df = flatten_collections(arr, specs)
+        df["target"] = np.full(len(df), target_label, dtype=TARGET_DTYPE)
+
+    return df
+
+def load_file(file_path, target_label, entry_stop=None, branches=None, specs=None, io_report=None, cuts=None,
+              cutflow=None, cache=None, report=None):
+    # One ROOT file, read up to entry_stop, with the same output as load_dataset_from_txt
+    if specs is None:
+        specs = default_specs()
+    if branches is None:
+        branches = branches_for_specs(specs, cuts)
+
+    arr, sizes = _read_file(file_path, branches, entry_stop, io_report is not None, cache, report)
+    _add_io(io_report, sizes)
+
+    with stage(report, "select"):
+        arr = apply_cuts(arr, cuts, cutflow)
+
+    return _flatten_block(arr, target_label, specs, report)
+
+def file_fingerprint(file_path, cache=None):
+    # Identifies the content of a ROOT file from its header only: the file
+    # UUID changes whenever the file is rewritten. The cache is only used in
+    # offline mode, online the remote file is asked directly so nothing is downloaded.
+    if cache is not None and not cache.offline:
+        cache = None
+
+    root_file, tree = _open_events(file_path, cache)
+    with root_file:
+        return {"uuid": str(root_file.file.uuid), "num_entries": int(tree.num_entries)}
+
+def _skim_columns(arr):
+    # Jagged branches of one collection (Electron_pt, Electron_eta) are zipped
+    # so uproot writes them back as nElectron, Electron_pt, Electron_eta
+    columns = {}
+    collections = {}
+    for name in arr.fields:
+        prefix, _, field = name.partition("_")
+        if field and arr[name].ndim > 1:
+            collections.setdefault(prefix, {})[field] = arr[name]
+        else:
+            columns[name] = ak.to_numpy(arr[name])
+    for prefix, fields in collections.items():
+        columns[prefix] = ak.zip(fields)
+    return columns
+
+def skim_file(file_path, out_path, branches, cuts=None, entry_stop=None, step_size="100 MB", cutflow=None,
+              cache=None, report=None):
+    # Writes the events of file_path that pass cuts, with only branches, to a
+    # local ROOT file with an "Events" tree, so it can be read like the
+    # original. Returns the number of events written.
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp = f"{out_path}.tmp"
+    written = 0
+
+    with stage(report, "open"):
+        root_file, tree = _open_events(file_path, cache)
+
+    with root_file, uproot.recreate(tmp) as out_file:
+        columns = _skim_columns(tree.arrays(branches, library="ak", entry_stop=0))
+        out_file.mktree("Events", {name: (value.dtype if isinstance(value, np.ndarray) else value.type)
+                                   for name, value in columns.items()})
+
+        chunks = tree.iterate(branches, library="ak", step_size=step_size, entry_stop=entry_stop)
+        while True:
+            with stage(report, "read"):
+                arr = next(chunks, None)
+            if arr is None:
+                break
+
+            with stage(report, "select"):
+                arr = apply_cuts(arr, cuts, cutflow)
+            if len(arr) == 0:
+                continue
+
+            with stage(report, "write"):
+                out_file["Events"].extend(_skim_columns(arr))
+            written += len(arr)
 
-    files = np.loadtxt(txt_file, dtype=str)
+    # Renamed when complete, an interrupted skim never looks finished
+    os.replace(tmp, out_path)
+    return written
+
+def skim_dataset_from_txt(txt_file, out_dir, branches, cuts=None, max_events=None, step_size="100 MB", cutflow=None,
+                          cache=None, report=None, metadata=None):
+    # Skims every file of an index (up to max_events read) into
+    # out_dir/<sample>/ and writes a file index with the same name as
+    # txt_file into out_dir, listing the skims. load_dataset_from_txt on that
+    # index reads the skims; max_events then counts preselected events.
+    files = np.atleast_1d(np.loadtxt(txt_file, dtype=str))
+    if metadata is None:
+        metadata = probe_files(files, cache=cache)
+
+    name = os.path.basename(txt_file)
+    skim_dir = os.path.join(out_dir, name.replace("_file_index.txt", ""))
+
+    skims = []
+    for file_path, _, entry_stop in plan_entry_ranges(files, metadata, max_events):
+        out_path = os.path.abspath(os.path.join(skim_dir, os.path.basename(file_path)))
+        skim_file(file_path, out_path, branches, cuts, entry_stop, step_size, cutflow, cache, report)
+        skims.append(out_path)
+
+    index = os.path.join(out_dir, name)
+    with open(index, "w") as f:
+        f.write("\n".join(skims) + "\n")
+
+    return index
+
+def load_dataset_from_txt(txt_file, target_label, max_events = None, branches = None, max_electrons=2, max_jets=4,
+                          n_workers=None, executor="process", specs=None, io_report=None, cuts=None, cutflow=None,
+                          cache=None, report=None, split_entries=None, metadata=None, prefetch=0):
+    # branches defaults to the ones needed by specs and cuts. Pass a dict as
+    # io_report to collect [compressed, uncompressed] bytes read per branch.
+    # max_events counts events read, before the cuts. With a RootFileCache
+    # the files are read from local copies. A RunReport as report records
+    # the open/read/select/concat/flatten stages. metadata from probe_files
+    # fixes the entry ranges before reading. With n_workers > 1 and
+    # split_entries, workers read entry ranges of about split_entries
+    # entries instead of whole files. Otherwise prefetch > 0 reads up to
+    # prefetch files ahead in a background thread.
+    
+    if specs is None:
+        specs = default_specs(max_electrons, max_jets)
+    if branches is None:
+        branches = branches_for_specs(specs, cuts)
+
+    files = np.atleast_1d(np.loadtxt(txt_file, dtype=str))
+
+    arrays = _read_files(files, branches, max_events=max_events, n_workers=n_workers, executor=executor,
+                         io_report=io_report, cuts=cuts, cutflow=cutflow, cache=cache, report=report,
+                         split_entries=split_entries, metadata=metadata, prefetch=prefetch)
+
+    with stage(report, "concat"):
+        data = ak.concatenate(arrays)
+
+    return _flatten_block(data, target_label, specs, report)
+
+def _iterate_chunks(files, branches, max_events=None, step_size="100 MB", io_report=None, cache=None, report=None):
+    # Chunks of step_size from the files in order until max_events entries are read
+    loaded = 0
 
     for file_path in files:
         if max_events is not None and loaded >= max_events:
             break
 
-        with uproot.open(file_path) as root_file:
-            tree = root_file["Events"]
+        with stage(report, "open"):
+            root_file, tree = _open_events(file_path, cache)
 
+        with root_file:
             events_left = None
             if max_events is not None:
                 events_left = max_events - loaded
 
-            arr = tree.arrays(
-                branches, 
-                library="ak",
-                entry_stop=events_left
-            )
+            if io_report is not None:
+                _add_io(io_report, _branch_bytes(tree, branches, events_left))
 
-        arrays.append(arr)
-        loaded += len(arr)
+            chunks = tree.iterate(branches, library="ak", step_size=step_size, entry_stop=events_left)
+            while True:
+                with stage(report, "read"):
+                    arr = next(chunks, None)
+                if arr is None:
+                    break
 
-    data = ak.concatenate(arrays)
+                loaded += len(arr)
+                yield arr
 
-    df_electrons = flatten_electrons(data, max_electrons=max_electrons)
-    df_jets = flatten_jets(data, max_jets=max_jets)
+def iterate_dataset_from_txt(txt_file, target_label, max_events = None, branches = None, max_electrons=2, max_jets=4,
+                             step_size="100 MB", specs=None, io_report=None, cuts=None, cutflow=None,
+                             cache=None, report=None, metadata=None, prefetch=0):
+    # Generator version of load_dataset_from_txt: every chunk of step_size
+    # (number of entries or a size string like "100 MB") is flattened and
+    # yielded right away, so only one chunk is held in memory at a time.
+    # With prefetch, up to prefetch further chunks are read in a background
+    # thread while the current one is flattened.
+    # All blocks have the same columns as load_dataset_from_txt.
+    
+    if specs is None:
+        specs = default_specs(max_electrons, max_jets)
+    if branches is None:
+        branches = branches_for_specs(specs, cuts)
+
+    files = np.atleast_1d(np.loadtxt(txt_file, dtype=str))
+    if metadata is not None:
+        # Empty files and files past the quota are not opened
+        files = list(dict.fromkeys(entry_range[0] for entry_range in plan_entry_ranges(files, metadata, max_events)))
 
-    df = pd.concat([df_electrons, df_jets], axis=1)
-    df["target"] = target_label
+    # With prefetch, the open and read stages of the background thread are
+    # handed over with every chunk, "prefetch_wait" is the time spent waiting
+    read_report = RunReport("prefetch", wall_only=True) if prefetch and report is not None else report
+    chunks = _iterate_chunks(files, branches, max_events, step_size, io_report, cache, read_report)
+    if prefetch:
+        chunks = prefetched(chunks, prefetch, read_report, report)
+
+    while True:
+        with stage(report if prefetch else None, "prefetch_wait"):
+            arr = next(chunks, None)
+        if arr is None:
+            break
 
-    return df.reset_index(drop=True)
+        with stage(report, "select"):
+            arr = apply_cuts(arr, cuts, cutflow)
+        yield _flatten_block(arr, target_label, specs, report)
 
 # For testing
 # branches = ["Electron_pt", "Electron_eta", "run", "event"]
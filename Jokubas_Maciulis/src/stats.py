@@ -0,0 +1,86 @@
+import numpy as np
+
+class FeatureStats:
+    # Per-feature count, mean, variance, min, max and fraction of zeros
+    # (the padding value of missing objects), accumulated chunk by chunk.
+    # Chunks and the stats of different workers are combined with the
+    # pairwise update of Chan et al., which stays accurate where the naive
+    # sum of squares loses precision, so any grouping of merges gives the
+    # same result as one pass over all rows.
+    def __init__(self, n_features):
+        self.count = 0
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+        self.zeros = np.zeros(n_features, dtype=np.int64)
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    def update(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        if len(X) == 0:
+            return self
+
+        mean = X.mean(axis=0)
+        self._combine(len(X), mean, ((X - mean) ** 2).sum(axis=0))
+        self.min = np.minimum(self.min, X.min(axis=0))
+        self.max = np.maximum(self.max, X.max(axis=0))
+        self.zeros += (X == 0).sum(axis=0)
+        return self
+
+    def merge(self, other):
+        merged = FeatureStats(len(self.mean))
+        for stats in (self, other):
+            if stats.count == 0:
+                continue
+            merged._combine(stats.count, stats.mean, stats.m2)
+            merged.min = np.minimum(merged.min, stats.min)
+            merged.max = np.maximum(merged.max, stats.max)
+            merged.zeros += stats.zeros
+        return merged
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    @property
+    def variance(self):
+        # Population variance, like StandardScaler
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def scale(self):
+        # Standard deviation with zeros replaced by 1, like StandardScaler
+        std = np.sqrt(self.variance)
+        std[std == 0] = 1
+        return std
+
+    @property
+    def zero_fraction(self):
+        return self.zeros / max(self.count, 1)
+
+    def to_dict(self):
+        return {
+            "count": int(self.count),
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "zeros": self.zeros.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        stats = cls(len(values["mean"]))
+        stats.count = values["count"]
+        stats.mean = np.array(values["mean"])
+        stats.m2 = np.array(values["m2"])
+        stats.min = np.array(values["min"])
+        stats.max = np.array(values["max"])
+        stats.zeros = np.array(values["zeros"], dtype=np.int64)
+        return stats
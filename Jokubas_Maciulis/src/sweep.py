@@ -0,0 +1,101 @@
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+import pandas as pd
+
+# The standardized train/validation arrays are copied once into shared
+# memory, every worker process maps them without a copy and trains one
+# configuration at a time with a fixed number of TensorFlow threads.
+
+def expand_grid(grid):
+    # {"hidden": [...], "learning_rate": [...], ...} -> one dict per combination
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+def to_shared(arrays):
+    # {name: array} -> shared memory blocks and the (name, shape, dtype) specs
+    # the workers need to attach to them
+    blocks = []
+    specs = {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def _init_worker(specs, n_threads):
+    global _arrays, _blocks
+
+    # Must be set before TensorFlow starts its thread pools
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(n_threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    _arrays = {}
+    _blocks = []
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _blocks.append(block)
+        _arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+def _train_config(config, seed=42):
+    import tensorflow as tf
+    from sklearn.metrics import roc_auc_score
+    from src.model import build_model
+
+    tf.keras.utils.set_random_seed(seed)
+    X_train, y_train = _arrays["X_train"], _arrays["y_train"]
+    X_val, y_val = _arrays["X_val"], _arrays["y_val"]
+
+    model = build_model(X_train.shape[1], hidden=config["hidden"], learning_rate=config["learning_rate"])
+
+    start = time.perf_counter()
+    history = model.fit(X_train, y_train, epochs=config["epochs"], batch_size=config["batch_size"],
+                        validation_data=(X_val, y_val), verbose=0)
+    train_s = time.perf_counter() - start
+
+    # Exact AUC of the final model plus the best epoch seen by Keras
+    scores = model.predict(X_val, batch_size=65536, verbose=0).ravel()
+    val_auc = history.history["val_auc"]
+
+    return dict(config,
+                hidden="-".join(map(str, config["hidden"])),
+                val_auc=float(roc_auc_score(y_val, scores)),
+                best_val_auc=float(max(val_auc)),
+                best_epoch=int(np.argmax(val_auc)) + 1,
+                train_s=train_s,
+                samples_per_s=len(X_train) * config["epochs"] / train_s)
+
+def run_sweep(arrays, configs, n_workers=None, threads_per_worker=1, seed=42):
+    # Trains every config on arrays (X_train, y_train, X_val, y_val) in
+    # n_workers processes and returns one row per config, best first.
+    # Workers are forked, which is safe as long as the calling process has
+    # not imported TensorFlow (TensorFlow is only imported in the workers).
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+    blocks, specs = to_shared(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context("fork"),
+                                 initializer=_init_worker, initargs=(specs, threads_per_worker)) as pool:
+            rows = []
+            for row in pool.map(_train_config, configs, itertools.repeat(seed)):
+                print(f"hidden={row['hidden']} lr={row['learning_rate']} batch={row['batch_size']}: "
+                      f"val AUC {row['val_auc']:.4f} in {row['train_s']:.1f} s")
+                rows.append(row)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return pd.DataFrame(rows).sort_values("val_auc", ascending=False).reset_index(drop=True)
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import awkward as ak
+import uproot
+
+# NanoAOD-like branches written for every collection, the ones the classifier
+# does not use are included so that branch pruning has something to skip
+ELECTRON_FIELDS = ["pt", "eta", "phi", "mass", "miniPFRelIso_all", "miniPFRelIso_chg", "dz", "dxy", "ip3d"]
+JET_FIELDS = ["pt", "eta", "phi", "mass", "btagDeepFlavB"]
+
+def _jagged(counts, values):
+    return ak.unflatten(values.astype(np.float32), counts)
+
+def _electrons(rng, n_events, dielectron_fraction):
+    # Mostly 0 or 1 electrons, plus a Drell-Yan like fraction with a pair
+    counts = rng.poisson(0.4, n_events)
+    pairs = rng.random(n_events) < dielectron_fraction
+    counts[pairs] += 2
+    n = counts.sum()
+
+    return counts, {
+        "pt": 10 + rng.exponential(20, n),
+        "eta": np.clip(rng.normal(0, 1.2, n), -2.5, 2.5),
+        "phi": rng.uniform(-np.pi, np.pi, n),
+        "mass": np.full(n, 0.000511),
+        "miniPFRelIso_all": rng.exponential(0.1, n),
+        "miniPFRelIso_chg": rng.exponential(0.05, n),
+        "dz": rng.normal(0, 0.02, n),
+        "dxy": rng.normal(0, 0.01, n),
+        "ip3d": rng.exponential(0.01, n),
+    }
+
+def _jets(rng, n_events):
+    counts = rng.poisson(3.5, n_events)
+    n = counts.sum()
+
+    return counts, {
+        "pt": 15 + rng.exponential(35, n),
+        "eta": np.clip(rng.normal(0, 1.8, n), -4.7, 4.7),
+        "phi": rng.uniform(-np.pi, np.pi, n),
+        "mass": rng.gamma(2, 4, n),
+        "btagDeepFlavB": rng.beta(0.4, 3, n),
+    }
+
+def write_synthetic_nanoaod(path, n_events, seed=0, dielectron_fraction=0.3, basket_entries=10_000):
+    # Writes an "Events" TTree with NanoAOD naming (nElectron, Electron_pt, ...).
+    # Events are written in pieces of basket_entries so the file has several
+    # baskets per branch, like real NanoAOD files.
+    rng = np.random.default_rng(seed)
+
+    n_electron, electron = _electrons(rng, n_events, dielectron_fraction)
+    n_jet, jet = _jets(rng, n_events)
+
+    data = {
+        "run": np.ones(n_events, dtype=np.uint32),
+        "luminosityBlock": (np.arange(n_events) // 1000).astype(np.uint32),
+        "event": np.arange(n_events, dtype=np.uint64),
+        "Electron": ak.zip({field: _jagged(n_electron, electron[field]) for field in ELECTRON_FIELDS}),
+        "Jet": ak.zip({field: _jagged(n_jet, jet[field]) for field in JET_FIELDS}),
+    }
+
+    with uproot.recreate(path) as root_file:
+        root_file.mktree("Events", {name: (value.dtype if isinstance(value, np.ndarray) else value.type)
+                                    for name, value in data.items()})
+        for start in range(0, n_events, basket_entries):
+            root_file["Events"].extend({name: value[start:start + basket_entries] for name, value in data.items()})
+
+def write_synthetic_index(out_dir, n_files, events_per_file, seed=0, **kwargs):
+    # Writes n_files synthetic files and a *_file_index.txt listing them,
+    # returns the index path
+    os.makedirs(out_dir, exist_ok=True)
+
+    paths = []
+    for i in range(n_files):
+        path = os.path.abspath(os.path.join(out_dir, f"synthetic_{i:03d}.root"))
+        write_synthetic_nanoaod(path, events_per_file, seed=seed + i, **kwargs)
+        paths.append(path)
+
+    index = os.path.join(out_dir, "synthetic_file_index.txt")
+    with open(index, "w") as f:
+        f.write("\n".join(paths) + "\n")
+
+    return index
@@ -0,0 +1,139 @@
+import contextlib
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+# A training run keeps its state in checkpoint_dir while it runs: the latest
+# weights and optimizer state with the epoch (BackupAndRestore) and the early
+# stopping state with the best weights so far. A killed run started again
+# with the same checkpoint_dir continues after its last finished epoch; these
+# files are removed when training ends. The epochs of all attempts are
+# logged to one CSV file, from which the full history is rebuilt.
+
+BACKUP_METADATA = "training_metadata.json"
+
+# Everything written to checkpoint_dir, by BackupAndRestore (with .bkp
+# copies) and ResumableEarlyStopping (with temporary files)
+CHECKPOINT_FILES = [
+    BACKUP_METADATA, "latest.weights.h5", f"{BACKUP_METADATA}.bkp", "latest.weights.h5.bkp",
+    "early_stopping-*.json", "best_weights-*.npz", "_early_stopping.json", "_best_weights.npz",
+]
+
+def clear_checkpoint(checkpoint_dir):
+    # Removes only the checkpoint files, so checkpoint_dir may be shared with
+    # other outputs, and the directory itself once it is empty
+    for pattern in CHECKPOINT_FILES:
+        for path in glob.glob(os.path.join(checkpoint_dir, pattern)):
+            os.remove(path)
+    with contextlib.suppress(OSError):
+        os.rmdir(checkpoint_dir)
+
+class ResumableEarlyStopping(tf.keras.callbacks.EarlyStopping):
+    # EarlyStopping that saves its best value, wait count and best weights
+    # after every epoch and restores them at the start of a resumed run.
+    # The state is saved before the backup of the same epoch, so a run killed
+    # in between has a state one epoch ahead of the backup. States are
+    # therefore kept per epoch (the last two) and a resume loads the one of
+    # the epoch the backup has.
+    def __init__(self, checkpoint_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.checkpoint_dir = checkpoint_dir
+
+    def _state_path(self, epochs):
+        return os.path.join(self.checkpoint_dir, f"early_stopping-{epochs}.json")
+
+    def _weights_path(self, epochs):
+        return os.path.join(self.checkpoint_dir, f"best_weights-{epochs}.npz")
+
+    def on_train_begin(self, logs=None):
+        super().on_train_begin(logs)
+        path = self._state_path(resumed_epoch(self.checkpoint_dir))
+        if not os.path.exists(path):
+            return
+
+        with open(path) as f:
+            state = json.load(f)
+        self.best, self.wait, self.best_epoch = state["best"], state["wait"], state["best_epoch"]
+        if self.restore_best_weights:
+            with np.load(self._weights_path(self.best_epoch + 1)) as weights:
+                self.best_weights = [weights[f"arr_{i}"] for i in range(len(weights.files))]
+
+    def on_train_end(self, logs=None):
+        super().on_train_end(logs)
+        clear_checkpoint(self.checkpoint_dir)
+
+    def on_epoch_end(self, epoch, logs=None):
+        super().on_epoch_end(epoch, logs)
+        if self.best is None:
+            return
+
+        # Files are named by the number of finished epochs, like the backup,
+        # and written through a temporary file so a kill never leaves half a file
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        if self.restore_best_weights and self.best_epoch == epoch:
+            tmp = os.path.join(self.checkpoint_dir, "_best_weights.npz")
+            np.savez(tmp, *self.best_weights)
+            os.replace(tmp, self._weights_path(epoch + 1))
+
+        tmp = os.path.join(self.checkpoint_dir, "_early_stopping.json")
+        with open(tmp, "w") as f:
+            json.dump({"best": float(self.best), "wait": self.wait, "best_epoch": self.best_epoch}, f)
+        os.replace(tmp, self._state_path(epoch + 1))
+
+        # Keep the states of this and the previous epoch and the best weights
+        # they refer to
+        keep = {self._state_path(epoch + 1), self._state_path(epoch), self._weights_path(self.best_epoch + 1)}
+        if os.path.exists(self._state_path(epoch)):
+            with open(self._state_path(epoch)) as f:
+                keep.add(self._weights_path(json.load(f)["best_epoch"] + 1))
+        saved = (glob.glob(os.path.join(self.checkpoint_dir, "early_stopping-*.json"))
+                 + glob.glob(os.path.join(self.checkpoint_dir, "best_weights-*.npz")))
+        for path in saved:
+            if path not in keep:
+                os.remove(path)
+
+def resumed_epoch(checkpoint_dir):
+    # Epochs finished by an interrupted run in checkpoint_dir, 0 if none
+    path = os.path.join(checkpoint_dir, BACKUP_METADATA)
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return json.load(f)["epoch"]
+
+def training_callbacks(checkpoint_dir, log_path, monitor="val_auc", patience=5, restart=False):
+    # Callbacks for a resumable model.fit: early stopping on monitor with the
+    # best weights restored at the end, a backup of the latest state after
+    # every epoch and the CSV log of all epochs. restart=True discards the
+    # checkpoint of an interrupted run.
+    epoch = 0 if restart else resumed_epoch(checkpoint_dir)
+    if epoch == 0:
+        clear_checkpoint(checkpoint_dir)
+
+    # Keep only the logged epochs the backup has, a run killed between the
+    # two may have logged one more
+    if epoch > 0 and os.path.exists(log_path):
+        log = pd.read_csv(log_path)
+        log[log["epoch"] < epoch].to_csv(log_path, index=False)
+
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+
+    return [
+        ResumableEarlyStopping(checkpoint_dir, monitor=monitor, mode="max", patience=patience,
+                               restore_best_weights=True, verbose=1),
+        # Not delete_checkpoint, which removes the whole directory;
+        # ResumableEarlyStopping clears the checkpoint files at the end
+        tf.keras.callbacks.BackupAndRestore(checkpoint_dir, delete_checkpoint=False),
+        tf.keras.callbacks.CSVLogger(log_path, append=epoch > 0),
+    ]
+
+def full_history(history, log_path):
+    # The history of all epochs, including the ones before a resume, so the
+    # plots show the whole training
+    log = pd.read_csv(log_path)
+    history.history = {key: log[key].tolist() for key in log.columns if key != "epoch"}
+    history.epoch = log["epoch"].tolist()
+    return history